@@ -0,0 +1,231 @@
+"""Time the scan -> preview -> commit -> undo pipeline on synthetic trees.
+
+Usage: python benchmarks/pipeline.py [-n FILES] [-r REPEAT] [-o FILE]
+                                     [--trees NAMES] [--compare FILE]
+
+Trees are generated in a temporary directory, which also serves as HOME
+so that the history, journal and logs of the runs don't end up in the
+real config directory. Results are written as JSON (to stdout unless -o
+is given) and can be compared with an earlier run through --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+
+TREES = ["flat", "deep", "wide", "unicode"]
+# Transform combinations as (name, options set on FileOps).
+TRANSFORMS = [
+    ("none", {}),
+    ("case", {"casecheck": True, "casemode": 3}),
+    ("space", {"spacecheck": True, "spacemode": 6}),
+    ("remove", {"removecheck": True, "remnonwords": True, "remdups": True,
+                "remsymbols": True}),
+    ("insert+delete", {"insertcheck": True, "insertedit": "x_",
+                       "deletecheck": True, "deletestart": 0,
+                       "deleteend": 2}),
+    ("replace", {"regex": True, "matchedit": "([a-z]+)_(\\d+)",
+                 "replaceedit": "\\2-\\1"}),
+    ("count", {"countcheck": True, "countpos": 0, "countsufedit": " "}),
+    ("count natural", {"countcheck": True, "countpos": 0, "countsufedit": " ",
+                       "sortmode": 1, "countdirs": True}),
+    ("media", {"mediamode": True}),
+    ("all", {"casecheck": True, "casemode": 2, "spacecheck": True,
+             "spacemode": 0, "removecheck": True, "remdups": True,
+             "remsymbols": True, "insertcheck": True, "insertedit": "x_",
+             "countcheck": True, "keepext": True}),
+]
+WORDS = ["track", "song", "live", "remix", "intro", "caf\xc3\xa9",
+         "mot\xc3\xb6rhead", "sigur r\xc3\xb3s", "\xd0\xba\xd0\xb8\xd0\xbd\xd0\xbe",
+         "\xe6\x9d\xb1\xe4\xba\xac", "\xef\xac\x81ve", "bj\xc3\xb6rk"]
+EXTS = [".mp3", ".flac", ".jpg", ".txt", ".tar.gz", ""]
+
+
+def make_name(rng, i, unicode_heavy=False):
+    if unicode_heavy:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(1, 4))]
+        return "{} {:06d}{}".format(" - ".join(words), i, rng.choice(EXTS))
+    return "{}_{}{}".format(rng.choice(WORDS[:5]), i, rng.choice(EXTS))
+
+
+def make_tree(path, shape, files, seed=0):
+    """Create a tree with about files files and return its root and the
+    recursion depth needed to reach all of them."""
+    rng = random.Random(seed)
+    root = os.path.join(path, shape)
+    os.makedirs(root)
+    if shape == "flat":
+        dirs, depth = [root], 0
+    elif shape == "deep":
+        # One chain of 20 nested directories.
+        dirs, depth = [root], 20
+        for i in range(depth):
+            dirs.append(os.path.join(dirs[-1], "level {:02d}".format(i)))
+            os.mkdir(dirs[-1])
+    elif shape == "wide":
+        # Many small directories one level down.
+        count, depth = max(1, int(files ** 0.5)), 1
+        dirs = [os.path.join(root, "dir_{:05d}".format(i))
+                for i in range(count)]
+    else:
+        count, depth = 10, 1
+        dirs = [os.path.join(root, "{} {}".format(rng.choice(WORDS), i))
+                for i in range(count)]
+    for d in dirs:
+        if not os.path.isdir(d):
+            os.mkdir(d)
+    for i in range(files):
+        name = make_name(rng, i, shape == "unicode")
+        open(os.path.join(dirs[i % len(dirs)], name), "w").close()
+    return root, depth
+
+
+def get_fileops(depth, options=None, **kwargs):
+    from fileops import FileOps
+    fileops = FileOps(quiet=True, recursive=depth > 0, recursivedepth=depth,
+                      **kwargs)
+    for option, value in (options or {}).items():
+        setattr(fileops, option, value)
+    return fileops
+
+
+def measure(func, repeat, setup=None):
+    """Return the timings of repeat calls of func and its last result."""
+    timings, result = [], None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return timings, result
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {"min": timings[0], "median": timings[len(timings) // 2],
+            "max": timings[-1], "runs": len(timings)}
+
+
+def run_tree(shape, workdir, args):
+    root, depth = make_tree(workdir, shape, args.files)
+    results = []
+
+    def record(operation, transform, timings, count):
+        results.append({"tree": shape, "operation": operation,
+                        "transform": transform, "targets": count,
+                        "seconds": summarize(timings)})
+        sys.stderr.write("{:<8} {:<13} {:<14} {:>8} targets {:>9.3f}s\n"
+                         .format(shape, operation, transform or "", count,
+                                 min(timings)))
+
+    fileops = get_fileops(depth, workers=args.workers)
+    timings, targets = measure(lambda: fileops.get_targets(root), args.repeat)
+    record("get_targets", None, timings, len(targets))
+
+    for name, options in TRANSFORMS:
+        fileops = get_fileops(depth, options, processes=args.processes)
+        timings, previews = measure(lambda: fileops.get_previews(targets),
+                                    args.repeat, fileops.clear_stages)
+        record("get_previews", name, timings, len(previews))
+
+    # Commit and undo always restore the tree, so they can be repeated.
+    fileops = get_fileops(depth, TRANSFORMS[4][1], workers=args.workers)
+    previews = fileops.get_previews(targets)
+    commits, undos = [], []
+    for _ in range(args.repeat):
+        commits.extend(measure(lambda: fileops.commit(previews), 1)[0])
+        timings, undone = measure(fileops.undo, 1)
+        if not undone:
+            sys.exit("Undo failed, {} is left renamed.".format(root))
+        undos.extend(timings)
+    record("commit", TRANSFORMS[4][0], commits, len(previews))
+    record("undo", TRANSFORMS[4][0], undos, len(previews))
+
+    shutil.rmtree(root)
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short",
+                                        "HEAD"],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the change of every timing relative to a baseline run."""
+    key = lambda r: (r["tree"], r["operation"], r["transform"])
+    before = dict((key(r), r) for r in baseline["results"])
+    sys.stderr.write("\nCompared to {} ({}):\n".format(
+                     baseline.get("revision"), baseline.get("date")))
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        ratio = result["seconds"]["min"] / max(old["seconds"]["min"], 1e-9)
+        sys.stderr.write("{:<8} {:<13} {:<14} {:>9.3f}s -> {:>9.3f}s {:+.0%}\n"
+                         .format(result["tree"], result["operation"],
+                                 result["transform"] or "",
+                                 old["seconds"]["min"],
+                                 result["seconds"]["min"], ratio - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--files", type=int, default=10000,
+                        help="files per tree [%(default)s]")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="runs per measurement [%(default)s]")
+    parser.add_argument("-o", "--output", help="write the JSON results here")
+    parser.add_argument("--trees", default=",".join(TREES),
+                        help="comma separated tree shapes [%(default)s]")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="scan and rename threads [%(default)s]")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="preview processes [%(default)s]")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="demimove-bench-")
+    os.environ["HOME"] = workdir
+    try:
+        results = []
+        for shape in args.trees.split(","):
+            if shape not in TREES:
+                parser.error("unknown tree: {}".format(shape))
+            results.extend(run_tree(shape, workdir, args))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "revision": get_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "options": vars(args),
+              "results": results}
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Time the preview lookups the view does for every painted cell.
+
+Usage: python benchmarks/previews.py [-n COUNTS] [-r REPEAT] [--rows ROWS]
+                                     [--scan-limit N]
+
+For each target count, a paint looks up the previews of --rows visible
+targets spread over the table, the way DirModel.match_preview does (minus
+Qt). The lookups go through the path index of the target and preview
+tables, so the paint column should stay flat as the count grows. The scan
+column repeats the membership test and index() on a list of target
+tuples that match_preview used to do, up to --scan-limit targets.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+from targets import PreviewTable, TargetTable
+
+
+def make_tables(count):
+    """Return targets and previews of count files in sqrt(count) dirs."""
+    targets = TargetTable()
+    dirs = max(1, int(count ** 0.5))
+    for d in xrange(dirs):
+        files = ["track_{:07d}.mp3".format(i) for i in xrange(d, count, dirs)]
+        targets.add_files("/music/album_{:05d}/".format(d), files)
+    previews = PreviewTable(targets, [f.upper() for f in targets.filenames])
+    return targets, previews
+
+
+def paint(targets, previews, paths):
+    """Look up the previews of paths like match_preview does."""
+    shown = []
+    for path in paths:
+        if targets.find(path) is None:
+            continue
+        preview = previews.find(path)
+        if preview is None:
+            continue
+        shown.append(preview if os.path.basename(path) != preview else "\\1")
+    return shown
+
+
+def paint_scan(targets, previews, visible):
+    """The lookup match_preview did before targets were indexed."""
+    shown = []
+    for target in visible:
+        if target in targets:
+            preview = previews[targets.index(target)][1]
+            shown.append(preview if target[1] + target[2] != preview
+                         else "\\1")
+    return shown
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--counts", default="1000,10000,100000,1000000",
+                        help="comma separated target counts [%(default)s]")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--rows", type=int, default=100,
+                        help="visible targets per paint [%(default)s]")
+    parser.add_argument("--scan-limit", type=int, default=100000,
+                        help="largest count to time the scan for "
+                             "[%(default)s]")
+    args = parser.parse_args()
+
+    print("{:>10} {:>10} {:>12} {:>12}".format("targets", "index",
+                                               "paint", "scan"))
+    for count in [int(c) for c in args.counts.split(",")]:
+        targets, previews = make_tables(count)
+        index = min(timeit.repeat(targets.build_index, number=1,
+                                  repeat=args.repeat))
+        step = max(1, count // args.rows)
+        rows = range(0, count, step)[:args.rows]
+        paths = [targets.path(r) for r in rows]
+        assert len(paint(targets, previews, paths)) == len(rows)
+        painttime = min(timeit.repeat(lambda: paint(targets, previews, paths),
+                                      number=1, repeat=args.repeat))
+        scan = ""
+        if count <= args.scan_limit:
+            tuples = list(targets)
+            oldpreviews = [((r, n + e), p) for (r, n, e), p
+                           in zip(tuples, previews.names)]
+            visible = [tuples[r] for r in rows]
+            scantime = min(timeit.repeat(lambda: paint_scan(tuples,
+                                                            oldpreviews,
+                                                            visible),
+                                         number=1, repeat=args.repeat))
+            scan = "{:>11.2f}ms".format(scantime * 1000)
+        print("{:>10} {:>9.3f}s {:>11.2f}ms {:>12}".format(
+              count, index, painttime * 1000, scan))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Find the target count from which the process pool computes previews
+faster than the serial path.
+
+Usage: python benchmarks/processes.py [-n COUNTS] [-p PROCESSES] [-r REPEAT]
+
+Times get_previews for every combination of target count and process
+count, with the transforms that benefit most from parallelism (remsymbols
+on accented names, case, space and count). processthreshold is disabled so
+that the pool is used at every size. The crossover of a process count is
+the smallest target count at which it beats the serial path and stays
+ahead at all larger counts; FileOps.processthreshold should be about that.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+
+OPTIONS = {"removecheck": True, "remsymbols": True, "casecheck": True,
+           "casemode": 0, "spacecheck": True, "spacemode": 6,
+           "countcheck": True}
+WORDS = ["Track", "Caf\xc3\xa9", "Mot\xc3\xb6rhead", "Sigur R\xc3\xb3s",
+         "Bj\xc3\xb6rk", "\xef\xac\x81ve", "live", "remix", "(2014)"]
+
+
+def make_targets(count, seed=0):
+    from targets import TargetTable
+    rng = random.Random(seed)
+    targets = TargetTable()
+    targets.add_files("/music/", ["{} {:07d}.mp3".format(
+                      " ".join(rng.choice(WORDS) for _ in range(3)), i)
+                      for i in xrange(count)])
+    return targets
+
+
+def get_fileops(processes):
+    from fileops import FileOps
+    fileops = FileOps(quiet=True, processes=processes)
+    fileops.processthreshold = 0
+    for option, value in OPTIONS.items():
+        setattr(fileops, option, value)
+    return fileops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--counts",
+                        default="5000,10000,20000,50000,100000,200000",
+                        help="comma separated target counts [%(default)s]")
+    parser.add_argument("-p", "--processes", default="2,4",
+                        help="comma separated process counts [%(default)s]")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    counts = [int(c) for c in args.counts.split(",")]
+    processes = [int(p) for p in args.processes.split(",")]
+    home = tempfile.mkdtemp(prefix="demimove-bench-")
+    os.environ["HOME"] = home
+    try:
+        print("{} cores".format(multiprocessing.cpu_count()))
+        print("{:>10} {:>10}".format("targets", "serial") +
+              "".join("{:>10}".format("{} procs".format(p))
+                      for p in processes))
+        timings = {}
+        serial = get_fileops(0)
+        pools = [get_fileops(p) for p in processes]
+        for count in counts:
+            targets = make_targets(count)
+            expected = serial.get_previews(targets).names
+            row = []
+            for fileops in [serial] + pools:
+                assert fileops.get_previews(targets).names == expected
+                row.append(min(timeit.repeat(
+                    lambda: fileops.get_previews(targets), number=1,
+                    repeat=args.repeat, setup=fileops.clear_stages)))
+            timings[count] = row
+            print("{:>10}".format(count) +
+                  "".join("{:>9.3f}s".format(t) for t in row))
+    finally:
+        shutil.rmtree(home)
+
+    for i, p in enumerate(processes, 1):
+        crossover = None
+        for count in reversed(counts):
+            if timings[count][i] >= timings[count][0]:
+                break
+            crossover = count
+        if crossover is None:
+            print("{} processes: no crossover up to {} targets.".format(
+                  p, counts[-1]))
+        else:
+            print("{} processes: faster from {} targets on.".format(
+                  p, crossover))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare the per-name transforms with their column versions.
+
+Usage: python benchmarks/transforms.py [-n NAMES] [-r REPEAT]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+from fileops import FileOps
+
+
+CASES = [
+    ("case lower", {"casemode": 0}, "case"),
+    ("case upper", {"casemode": 1}, "case"),
+    ("case capitalize", {"casemode": 2}, "case"),
+    ("space to underscore", {"spacemode": 0}, "space"),
+    ("space and dot to underscore", {"spacemode": 6}, "space"),
+    ("delete range", {"deletecheck": True, "deletestart": 2,
+                      "deleteend": 5}, "delete"),
+    ("remove nonwords", {"remnonwords": True}, "remove"),
+    ("remove duplicates", {"remdups": True}, "remove"),
+    ("remove symbols", {"remsymbols": True}, "remove"),
+]
+
+
+def make_names(count, seed=0):
+    rng = random.Random(seed)
+    words = ["Track", "the", "Song", "live", "remix", "feat.", "Caf\xc3\xa9",
+             "--", "__", "  ", "01", "Mot\xc3\xb6rhead", "(2014)",
+             "Sigur R\xc3\xb3s", "\xd0\x9a\xd0\xb8\xd0\xbd\xd0\xbe",
+             "\xe6\x9d\xb1\xe4\xba\xac", "Bj\xc3\xb6rk", "\xef\xac\x81ve"]
+    return [" ".join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+            for _ in xrange(count)]
+
+
+def get_fileops(options):
+    fileops = FileOps(quiet=True, casemode=0, spacemode=0)
+    fileops.casecheck = fileops.spacecheck = fileops.removecheck = True
+    for option, value in options.items():
+        setattr(fileops, option, value)
+    return fileops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--names", type=int, default=100000)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    names = make_names(args.names)
+    print("{:<30} {:>10} {:>10} {:>8}".format("stage", "per name", "column",
+                                                "speedup"))
+    for label, options, stage in CASES:
+        fileops = get_fileops(options)
+        apply_stage = getattr(fileops, "apply_" + stage)
+        batch_stage = getattr(fileops, "batch_" + stage)
+        assert batch_stage(names) == [apply_stage(s) for s in names]
+        pername = min(timeit.repeat(lambda: [apply_stage(s) for s in names],
+                                    number=1, repeat=args.repeat))
+        column = min(timeit.repeat(lambda: batch_stage(names), number=1,
+                                   repeat=args.repeat))
+        print("{:<30} {:>9.3f}s {:>9.3f}s {:>7.1f}x".format(
+              label, pername, column, pername / column))
+
+
+if __name__ == "__main__":
+    main()
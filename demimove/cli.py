@@ -3,6 +3,7 @@
 
 Usage:
     demimove [<matchpattern> [<replacepattern>]] [-d|-f] [-v|-vv|-vvv] [options]
+    demimove --plan [-v|-vv|-vvv] [options]
 
 Arguments:
     matchpattern    (Optional) Pattern to identify targets by.
@@ -16,6 +17,10 @@ Arguments:
 Options:
     -a, --all              Include hidden files/directories.
     -c, --count=<n>        Inserts an index at position n counting up from 1.
+    -O, --sortmode=<n>     Order targets are counted in: 0 = by name,
+                           1 = natural (numbers by value, ignoring case)
+                           [default: 0].
+    --count-per-dir        Count the targets of each directory separately.
     -d, --dirsonly         Only search directory names. Default is files + dirs.
     -e, --exclude=<names>  Exclude files/directories (glob). Colon separated.
     -f, --filesonly        Only search file names. Default is files + dirs.
@@ -23,8 +28,31 @@ Options:
     -i, --interactive      Confirm before renaming.
     -n, --no-clobber       Do not overwrite an existing file.
     -p, --path=<path>      Specify the path to start in. Otherwise cwd is used.
+    --from=<file>          Read the target paths from a file (- for stdin)
+                           instead of searching --path, one per line.
+    -0, --null             Paths read by --from end with a null byte instead
+                           of a newline, as printed by find -print0.
+    -P, --processes=<n>    Compute previews of large target sets in n
+                           worker processes [default: 0].
     -r, --recursive        Apply changes recursively.
+    -L, --depth=<n>        How many levels --recursive descends [default: 100].
     -s, --simulate         Do a test run and dump the results to console.
+    -F, --format=<fmt>     Output as text, ndjson (one JSON object per rename,
+                           with src, dst, status and reason, plus src_base64
+                           and dst_base64 for paths that aren't UTF-8) or
+                           null (source and destination path, each
+                           terminated by a null byte) [default: text].
+    --plan                 Read renames from stdin instead of searching for
+                           targets. Expects the ndjson or null output of an
+                           earlier (simulated) run, matching --format.
+    --resume               Finish a commit that was interrupted. With
+                           --simulate, only list the renames left.
+    --rollback             Revert the renames of an interrupted commit.
+    --cache                Cache directory listings between runs and only
+                           rescan directories that changed.
+    --stats                Print counters and timings of the run to stderr.
+    -w, --workers=<n>      Threads used to scan directories in parallel
+                           (recursive mode only) [default: 1].
     -C, --casemode=<n>     0 = All lowercase, 1 = uppercase, 2 = capitalize.
     -D, --remduplicates    Remove duplicate symbols.
     -E, --remextensions    Remove filetype extensions.
@@ -41,13 +69,27 @@ Options:
     --version              Show the current demimove version.
     -h, --help             Show this help message and exit.
 
+Previews are printed while the targets are searched, one directory at a
+time. Renames are carried out in batches of whole directories, renames of
+directories last. A --plan has to list the renames of a directory together,
+like the output of --simulate does.
+
 Examples:
     dmv "*.txt" "*.pdf" (will replace all .txt remext with .pdf)
     dmv -f "*" "season-*" (will prepend "season-" to every file in the cwd)
+    dmv -rsM -F null | dmv --plan -F null (review first, then rename)
+    find . -name "*.MP3" -print0 | dmv --from - -0 -C 0 (lowercase found files)
 """
 # TODO: Better examples..
+import base64
+import json
+import logging
+import os
+import stat
 import sys
 
+import helpers
+
 from fileops import FileOps
 
 
@@ -58,10 +100,133 @@ except ImportError:
     sys.exit()
 
 
+log = logging.getLogger("cli")
+FORMATS = ["text", "ndjson", "null"]
+
+
+def decode(path):
+    if isinstance(path, unicode):
+        return path
+    return path.decode("utf-8", "replace")
+
+
+def add_path(record, key, path):
+    """Store path in a JSON record. JSON can only hold text, so paths
+    that aren't valid UTF-8 are also stored as base64 under key_base64,
+    which read_plan prefers over the (lossy) text."""
+    path = encode(path)
+    try:
+        record[key] = path.decode("utf-8")
+    except UnicodeDecodeError:
+        record[key] = decode(path)
+        record[key + "_base64"] = base64.b64encode(path)
+
+
+def get_path(record, key):
+    if key + "_base64" in record:
+        return base64.b64decode(record[key + "_base64"])
+    return encode(record[key])
+
+
+def encode(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+def write_result(fmt, src, dst, status, reason=None):
+    """Print a previewed (status "preview"), finished ("done") or skipped
+    rename. Text and null output print skipped renames to stderr, null
+    output can't hold the reason and is meant to be read back by --plan."""
+    if fmt == "ndjson":
+        record = {"status": status}
+        add_path(record, "src", src)
+        add_path(record, "dst", dst)
+        if reason is not None:
+            record["reason"] = reason
+        sys.stdout.write(json.dumps(record) + "\n")
+    elif status == "skipped":
+        sys.stderr.write("Skipped {} -> {} ({}).\n".format(src, dst, reason))
+    elif fmt == "null":
+        sys.stdout.write(encode(src) + "\0" + encode(dst) + "\0")
+    else:
+        sys.stdout.write("{} -> {}\n".format(src, dst))
+
+
+def read_plan(stream, fmt):
+    """Yield the (source, destination) renames of a plan on stream."""
+    if fmt == "null":
+        records = helpers.iter_records(stream, "\0")
+        for src in records:
+            dst = next(records, None)
+            if dst is None:
+                log.error("Plan ends with a source without destination.")
+                return
+            yield src, dst
+        return
+    for line in helpers.iter_records(stream, "\n"):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            log.error("Skipping invalid plan line: {}.".format(line))
+            continue
+        # Only previews can be replayed, finished or skipped ones can't.
+        if record.get("status", "preview") != "preview":
+            continue
+        try:
+            yield get_path(record, "src"), get_path(record, "dst")
+        except (KeyError, TypeError):
+            log.error("Skipping invalid plan line: {}.".format(line))
+
+
+def iter_dirs(actions):
+    """Group consecutive renames by the directory of their source, so that
+    a plan is only ever cut between directories, where no chain or swap
+    can be split up."""
+    chunk, root = [], None
+    for action in actions:
+        parent = os.path.dirname(action[0].rstrip("/"))
+        if parent != root and chunk:
+            yield chunk
+            chunk = []
+        chunk.append(action)
+        root = parent
+    if chunk:
+        yield chunk
+
+
+def split_dirs(batches):
+    """Split every batch of a plan into the renames of files and those of
+    directories, as FileOps.commit_stream expects them. A plan doesn't
+    record which is which, so every source is looked up once."""
+    for actions in batches:
+        files, dirs = [], []
+        for action in actions:
+            try:
+                isdir = stat.S_ISDIR(os.lstat(action[0]).st_mode)
+            except OSError:
+                isdir = False
+            (dirs if isdir else files).append(action)
+        yield files, dirs
+
+
+def confirm(batches):
+    """Ask before every batch of renames is carried out."""
+    for files, dirs in batches:
+        for src, dst in files + dirs:
+            sys.stderr.write("{} -> {}\n".format(src, dst))
+        sys.stderr.write("Rename {} targets? [y/N] ".format(len(files) +
+                                                           len(dirs)))
+        if sys.stdin.readline().strip().lower() in ("y", "yes"):
+            yield files, dirs
+
+
 def main():
     args = docopt(__doc__, version="0.1")
     fileops = FileOps(casemode=args["--casemode"],
                       countpos=args["--count"],
+                      countdirs=args["--count-per-dir"],
+                      sortmode=args["--sortmode"],
                       dirsonly=args["--dirsonly"],
                       exclude=args["--exclude"],
                       filesonly=args["--filesonly"],
@@ -72,6 +237,11 @@ def main():
                       mediamode=args["--media"],
                       noclobber=args["--no-clobber"],
                       recursive=args["--recursive"],
+                      recursivedepth=int(args["--depth"]),
+                      workers=args["--workers"],
+                      processes=args["--processes"],
+                      cache=args["--cache"],
+                      stats=args["--stats"],
                       regex=args["--regex"],
                       remdups=args["--remduplicates"],
                       remext=args["--remextensions"],
@@ -83,7 +253,60 @@ def main():
                       verbosity=args["-v"],
                       matchpattern=args["<matchpattern>"],
                       replacepattern=args["<replacepattern>"])
-    fileops.get_previews(fileops.get_targets(args["--path"]))
+    fmt = args["--format"]
+    if fmt not in FORMATS:
+        sys.exit("Unknown format: {}.".format(fmt))
+    if args["--resume"]:
+        status = "preview" if fileops.simulate else "done"
+        for src, dst in fileops.resume():
+            write_result(fmt, src, dst, status)
+        return
+    if args["--rollback"]:
+        fileops.rollback()
+        return
+    if fileops.journal.exists() and not fileops.simulate:
+        if fileops.journal.locked():
+            sys.exit("Another commit is running, wait for it to finish.")
+        sys.exit("An interrupted commit was found. Use --resume to finish it "
+                 "or --rollback to revert it.")
+    source = args["--from"]
+    if (args["--plan"] or source == "-") and fileops.interactive:
+        sys.exit("--interactive needs stdin, it can't be used with --plan "
+                 "or --from -.")
+    if args["--plan"] and source:
+        sys.exit("--plan and --from can't be used together.")
+
+    if args["--plan"]:
+        batches = split_dirs(iter_dirs(read_plan(sys.stdin, fmt)))
+    else:
+        if source:
+            stream = sys.stdin if source == "-" else open(source, "rb")
+            paths = helpers.iter_records(stream,
+                                         "\0" if args["--null"] else "\n")
+            targets = fileops.iter_targets_from(paths)
+        else:
+            targets = fileops.iter_targets(args["--path"])
+        batches = ((list(previews.actions(dirs=False)),
+                    list(previews.actions(dirs=True))) for _, previews
+                   in fileops.iter_previews(targets))
+
+    if fileops.simulate:
+        for files, dirs in batches:
+            for src, dst in files + dirs:
+                write_result(fmt, src, dst, "preview")
+    else:
+        if fileops.interactive:
+            batches = confirm(batches)
+        for done, skipped in fileops.commit_stream(batches):
+            for src, dst in done:
+                write_result(fmt, src, dst, "done")
+            for src, dst, reason in skipped:
+                write_result(fmt, src, dst, "skipped", reason)
+            sys.stdout.flush()
+
+    if fileops.stats.enabled:
+        for line in fileops.stats.format():
+            sys.stderr.write(line + "\n")
 
 
 if __name__ == "__main__":
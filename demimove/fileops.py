@@ -1,16 +1,47 @@
 # -*- coding: utf-8 -*-
-from unicodedata import normalize
+from multiprocessing.pool import ThreadPool
+import collections
 import fnmatch
+import itertools
 import logging
+import multiprocessing
 import os
 import re
 import string
+import threading
+import time
 
 import helpers
-from operator import itemgetter
+import historystore
+import journal
+import listcache
+import planner
+from stats import Stats
+from functools import partial
+from itertools import izip
+from targets import PreviewTable, TargetTable
+from operator import itemgetter, methodcaller
 
 
 log = logging.getLogger("fileops")
+# Replacements of the space modes 0-5, mode 6 uses spacerx.
+SPACEMODES = {0: (" ", "_"), 1: (" ", "-"), 2: (" ", "."), 3: (".", " "),
+              4: ("-", " "), 5: ("_", " ")}
+spacerx = re.compile("[.\s]")
+# Like \W but keeps the null bytes that separate joined names.
+nonwordrx = re.compile("[^\w\0]")
+duplicaterx = re.compile(r"([-_ .])\1+")
+_fileops = None  # FileOps instance of a preview worker process.
+
+
+def _init_worker(fileops):
+    global _fileops
+    _fileops = fileops
+
+
+def _modify_chunk(chunk):
+    previews, counts = chunk
+    return _fileops.modify_previews(previews, counts, parallel=False).names
 
 
 class FileOps(object):
@@ -21,7 +52,9 @@ class FileOps(object):
                  noclobber=False, recursive=False, regex=False, remdups=False,
                  remext=False, remnonwords=False, remsymbols=False,
                  simulate=False, spacemode=0, quiet=False, verbosity=1,
-                 matchpattern="", replacepattern="", recursivedepth=0):
+                 matchpattern="", replacepattern="", recursivedepth=0,
+                 workers=1, processes=0, cache=False, stats=False,
+                 sortmode=0, countdirs=False):
         # Universal options:
         try:
             self._casemode = int(casemode)  # 0=lc, 1=uc, 2=flfw, 3=flew
@@ -38,7 +71,7 @@ class FileOps(object):
         self._dirsonly = dirsonly  # Only edit directory names.
         self._filesonly = False if dirsonly else filesonly  # Only file names.
         self._hidden = hidden  # Look at hidden files and directories, too.
-        self._ignorecase = ignorecase  # Case sensitivity.
+        self._ignorecase = re.I if ignorecase else 0  # Case sensitivity.
         self._interactive = interactive  # Confirm before overwriting.
         self._keepext = keepext  # Don't modify remext.
         self._mediamode = mediamode  # Mode to sanitize NTFS-filenames/dirnames.
@@ -50,6 +83,21 @@ class FileOps(object):
         self._remnonwords = remnonwords  # Only allow wordchars (\w)
         self._remsymbols = remsymbols  # Normalize remsymbols (ñé becomes ne).
         self._simulate = simulate  # Simulate renaming and dump result to stdout.
+        try:
+            self._workers = max(1, int(workers))  # Threads to scan dirs with.
+        except (TypeError, ValueError):
+            self._workers = 1
+        try:
+            # Processes to compute previews with, 0 or 1 disables them.
+            self._processes = int(processes)
+        except (TypeError, ValueError):
+            self._processes = 0
+        # Minimum amount of targets before worker processes are used.
+        self.processthreshold = 20000
+        # Targets per block between checks of stopupdate in the transforms.
+        self.blocksize = 4096
+        # Renames commit_stream collects before it plans and journals them.
+        self.streamsize = 10000
         # Initialize GUI options.
         self._recursivedepth = recursivedepth
         self._excludeedit = "" if not exclude else exclude
@@ -57,10 +105,15 @@ class FileOps(object):
         self._replaceedit = "" if not replacepattern else replacepattern
         self._autostop = False  # Automatically stop execution on rename error.
         self._countbase = 1  # Base to start counting from.
+        self._countdirs = countdirs  # Count each directory from countbase.
         self._countfill = True  # 9->10: 9 becomes 09. 99->100: 99 becomes 099.
         self._countpreedit = ""  # String that is prepended to the counter.
         self._countstep = 1  # Increment per count iteration.
         self._countsufedit = ""  # String that is appended to the counter.
+        try:
+            self._sortmode = int(sortmode)  # Count order, see targets.SORTKEYS.
+        except (TypeError, ValueError):
+            self._sortmode = 0
         self._deletecheck = False  # Whether to delete a specified range.
         self._deleteend = 1  # End index of deletion sequence.
         self._deletestart = 0  # Start index of deletion sequence.
@@ -78,8 +131,17 @@ class FileOps(object):
         removelist = [remdups, remext, remnonwords, remsymbols]
         self._removecheck = True if any(removelist) else False
         self._spacecheck = True if isinstance(spacemode, str) else False
+        self.patterns = {}  # Compiled match/filter/exclude patterns.
+        self.clear_stages()  # Cached output of each transform stage.
         self.stopupdate = False
         self.stopcommit = False
+        # Counters and timers of scans, transforms and commits.
+        self.stats = Stats(stats)
+        self.commitlock = threading.Lock()
+        self.commitstats = {}  # Progress of the running or last commit.
+        # Temporary name -> source of the last planned renames, see
+        # planner.get_parked.
+        self.parked = {}
         self.includes = set()
         self.excludes = set()
         self.recursiveincludes = set()
@@ -87,50 +149,71 @@ class FileOps(object):
         self.configdir = helpers.get_configdir()
         # Create the logger.
         helpers.configure_logger(verbosity, quiet, self.configdir)
+        # Persistent directory listing cache, see the cache property.
+        self.listingcache = None
+        self.cache = cache
         self.history = []  # History of commited operations, used to undo them.
+        # Persistent history of all commits, None if it can't be opened.
+        # Only used by one thread at a time: the commit thread while
+        # committing, the caller otherwise.
+        try:
+            self.historystore = historystore.HistoryStore(self.configdir)
+        except Exception as e:
+            log.error("Could not open history database: {}.".format(e))
+            self.historystore = None
+        # Write-ahead log of the running commit, see resume and rollback.
+        self.journal = journal.Journal(self.configdir)
+        # Characters kept by remsymbols, built up as they are seen.
+        self.symboltable = helpers.TransliterationTable(
+            string.ascii_letters + string.digits + " .-_+")  # []()
         # Match everything inside one set of braces:
         self.bracerx = re.compile("(?<=\{)(.*?)(?=\})")
 
+    def get_patterns(self, edit):
+        """Return the compiled patterns for a pattern edit, cached until one
+        of the pattern options changes."""
+        try:
+            return self.patterns[edit]
+        except KeyError:
+            pass
+        text = getattr(self, edit)
+        if edit == "matchedit":
+            if not self.regex:
+                matchpat = fnmatch.translate(text)
+                replacepat = helpers.translate(self.replaceedit)
+            else:
+                matchpat = text
+                replacepat = self.replaceedit
+            try:
+                patterns = (re.compile(matchpat, self.ignorecase), replacepat)
+            except re.error:
+                log.debug("Invalid match pattern: {}.".format(text))
+                patterns = None
+        else:
+            patterns = helpers.compile_patterns(text, self.regex,
+                                                self.ignorecase)
+        self.patterns[edit] = patterns
+        return patterns
+
+    def clear_patterns(self):
+        self.patterns = {}
+
     def match_filter(self, target):
         """Match a file/directory name against a glob/regex pattern."""
         if not self.filteredit:
             return True
-        if "/" in self.filteredit:
-            patterns = self.filteredit.split("/")
-        else:
-            patterns = [self.filteredit]
-        if self.regex:
-            for pattern in patterns:
-                try:
-                    if re.search(pattern, target, flags=self.ignorecase):
-                        return True
-                except:
-                    pass
-        else:
-            for pattern in patterns:
-                if fnmatch.fnmatch(target, pattern):
-                    return True
+        for rx in self.get_patterns("filteredit"):
+            if rx.search(target):
+                return True
         return False
 
     def match_exclude(self, target):
         """Match a file/directory name against a glob/regex pattern."""
         if not self.excludeedit:
             return
-        if "/" in self.excludeedit:
-            patterns = self.excludeedit.split("/")
-        else:
-            patterns = [self.excludeedit]
-        if self.regex:
-            for pattern in patterns:
-                try:
-                    if re.search(pattern, target, flags=self.ignorecase):
-                        return False
-                except:
-                    pass
-        else:
-            for pattern in patterns:
-                if fnmatch.fnmatch(target, pattern):
-                    return False
+        for rx in self.get_patterns("excludeedit"):
+            if rx.search(target):
+                return False
 
     def match(self, target):
         """Searches target for pattern and returns a bool."""
@@ -148,18 +231,19 @@ class FileOps(object):
                 return False
         return True
 
-    def get_dirs(self, root, dirs):
-        """Match and decode (from utf-8 to unicode) a list of dirs."""
-        return [(root, d, "") for d in dirs if self.match(d)]
-#         return sorted((root, d, "") for d in dirs if self.match(d))
-
-    def get_files(self, root, files):
-        """Match and decode (from utf-8 to unicode) a list of files."""
-        return [(root,) + os.path.splitext(f) for f in files if self.match(f)]
-#         return sorted((root,) + os.path.splitext(f) for f in files if self.match(f))
-
-    def get_targets(self, path=None):
-        """Return a list of files and/or dirs in path."""
+    def get_targets_in(self, root, dirs, files):
+        """Return the matching dirs and/or files of root as a TargetTable."""
+        target = TargetTable()
+        if not self.filesonly:
+            target.add_dirs(root, [d for d in dirs if self.match(d)])
+        if not self.dirsonly:
+            target.add_files(root, [f for f in files if self.match(f)])
+        return target
+
+    def iter_targets(self, path=None, roots=None):
+        """Yield the files and/or dirs in path as one TargetTable per
+        directory. If roots is a list, every walked directory is appended
+        to it."""
         if not path:
             path = os.getcwd()
 
@@ -168,29 +252,124 @@ class FileOps(object):
         if self.recursive:
             levels = self.recursivedepth
 
-        targets = []
-        for root, dirs, files in helpers.walklevels(path, levels):
-            root += "/"
-            if self.dirsonly:
-                target = self.get_dirs(root, dirs)
-            elif self.filesonly:
-                target = self.get_files(root, files)
-            else:
-                target = self.get_dirs(root, dirs) + self.get_files(root, files)
+        lister = helpers.listdir
+        if self.listingcache is not None:
+            lister = self.listingcache.listdir
+
+        if self.workers > 1 and levels:
+            walk = helpers.walklevels_parallel(path, levels, self.workers,
+                                               lambda: self.stopupdate,
+                                               lister)
+        else:
+            walk = helpers.walklevels(path, levels, lister)
 
-            targets.extend(target)
+        stats = self.stats
+        try:
+            for root, dirs, files in walk:
+                if roots is not None:
+                    roots.append(root)
+                target = self.get_targets_in(root + "/", dirs, files)
+                if stats.enabled:
+                    candidates = ((0 if self.filesonly else len(dirs)) +
+                                  (0 if self.dirsonly else len(files)))
+                    stats.count("dirs walked")
+                    stats.count("entries matched", len(target))
+                    stats.count("entries excluded", candidates - len(target))
+                if target:
+                    yield target
+
+                # Exit out of iter_targets when "Stop" is pressed in the GUI.
+                if self.stopupdate:
+                    return
+        finally:
+            if self.listingcache is not None:
+                self.listingcache.save()
+
+    def iter_targets_from(self, paths, batchsize=10000):
+        """Yield the files and/or dirs listed in paths, e.g. the records of
+        find -print0, as TargetTables instead of walking a directory. Paths
+        are normalized, split with helpers.splitpath and matched like
+        walked targets. Relative paths are taken relative to the working
+        directory, ".", ".." and "/" are skipped.
+
+        Tables are only cut between directories, once they hold batchsize
+        targets: entries of a directory are held back while the input is
+        still in its subtree, as in the output of find, where they can be
+        interleaved with those of its subdirectories."""
+        cwd = os.getcwd()
+        pending, count = collections.OrderedDict(), 0  # root -> (dirs, files)
+        for path in itertools.chain(paths, [None]):
+            if path is not None:
+                if path.rstrip("/").rsplit("/", 1)[-1] in ("", ".", ".."):
+                    log.debug("Skipping {}.".format(path))
+                    continue
+                path = os.path.normpath(os.path.join(cwd, path))
+                parts = helpers.splitpath(path)
+                if parts is None or not parts[1] + parts[2]:
+                    log.debug("Skipping {}.".format(path))
+                    continue
+                root = parts[0]
+            if path is None or count >= batchsize:
+                if path is None:
+                    finished = list(pending)
+                else:
+                    finished = [r for r in pending if not root.startswith(r)]
+                batch = TargetTable()
+                for r in finished:
+                    dirs, files = pending.pop(r)
+                    count -= len(dirs) + len(files)
+                    batch.extend(self.get_targets_from(r, dirs, files))
+                if batch:
+                    yield batch
+                if path is None or self.stopupdate:
+                    return
+            # Directories have no extension, so the type is needed. Like in
+            # walked listings, symlinks to directories count as directories.
+            dirs, files = pending.setdefault(root, ([], []))
+            filename = parts[1] + parts[2]
+            if os.path.isdir(path):
+                dirs.append(filename)
+            else:
+                files.append(filename)
+            count += 1
+
+    def get_targets_from(self, root, dirs, files):
+        """Return the matching dirs and files of a root read from a list of
+        paths, counting them like walked ones."""
+        target = self.get_targets_in(root, dirs, files)
+        stats = self.stats
+        if stats.enabled:
+            candidates = ((0 if self.filesonly else len(dirs)) +
+                          (0 if self.dirsonly else len(files)))
+            stats.count("entries matched", len(target))
+            stats.count("entries excluded", candidates - len(target))
+        return target
+
+    def get_targets(self, path=None, roots=None):
+        """Return a TargetTable of the files and/or dirs in path."""
+        targets = TargetTable()
+        with self.stats.timer("scan"):
+            for target in self.iter_targets(path, roots):
+                targets.extend(target)
+
+        if self.stopupdate:
+            return targets
 
-            # Exit out of get_targets when "Stop" is pressed in the GUI.
-            if self.stopupdate:
-                return targets
+        with self.stats.timer("sort"):
+            return self.sort_targets(targets)
 
+    def sort_targets(self, targets):
+        """Rank targets by sortmode if they are going to be counted.
+        Counters follow the ranks, so the targets keep their order and the
+        ranks are reused by every preview until targets are added."""
         if self.countcheck:
-            return sorted(targets, key=lambda i: i[1] + i[2])
-        else:
-            return targets
+            targets.get_ranks(self.sortmode, self.countdirs)
+        return targets
 
-    def get_previews(self, targets, matchpat=None, replacepat=None):
-        """Simulate rename operation on targets and return results as list."""
+    def get_previews(self, targets, matchpat=None, replacepat=None,
+                     stoppable=True):
+        """Simulate rename operation on targets and return a PreviewTable,
+        or None if the update was stopped (see modify_previews)."""
         if matchpat is not None:
             self.matchedit = matchpat
         if replacepat is not None:
@@ -198,8 +377,25 @@ class FileOps(object):
         if self.mediamode:
             self.set_mediaoptions()
 
-        return self.modify_previews(targets)
-#         return sorted(self.modify_previews(targets), key=lambda i: i[0][1])
+        with self.stats.timer("previews"):
+            return self.modify_previews(targets, stoppable=stoppable)
+
+    def iter_previews(self, batches, matchpat=None, replacepat=None):
+        """Simulate rename operation on batches of targets (e.g. from
+        iter_targets) and yield (targets, previews) per batch as soon as it
+        is ready. Counting needs the complete and ranked target list, so
+        with countcheck enabled all batches are collected first."""
+        if self.countcheck:
+            targets = TargetTable()
+            for batch in batches:
+                targets.extend(batch)
+            batches = [self.sort_targets(targets)]
+
+        for batch in batches:
+            previews = self.get_previews(batch, matchpat, replacepat)
+            if previews is None:
+                return
+            yield batch, previews
 
     def set_mediaoptions(self):
         self.casecheck = True
@@ -212,117 +408,515 @@ class FileOps(object):
         self.remsymbols = True
 
     def commit(self, previews):
-        # Reverse sort the paths (by counting the amount of slashs in the path)
-        # so that the longest paths are renamed first.
-        # This should minimize rename errors for recursive operations, for now.
-        actions = sorted((("".join(i[0]), i[0][0] + i[1]) for i in previews),
-                         key=lambda i: i[0].count("/"), reverse=True)
-
-        for i in actions:
-            log.debug("{} -> {}.".format(i[0], i[1]))
-            # TODO: Implement a check for overwriting.
-            if i[0] == i[1]:
-                log.warn("File already exists. Skipping.")
-                continue
-            if self.simulate:
-                continue
+        """Rename the targets of previews to their previewed names."""
+        done, skipped = self.commit_actions(previews.actions())
+        self.record_history(done)
+        if self.stopcommit:
+            log.warn("Stopping commit after {} renames." .format(len(done)))
+            if done:
+                log.warn("Use undo to revert the rename actions.")
+            return
+        log.info("Renaming complete.")
+
+    def commit_actions(self, actions):
+        """Plan and run (source, destination) renames without recording
+        them in the history. Returns (done, skipped), skipped holding
+        (source, destination, reason) of every rename that was not done.
+
+        The renames are ordered by planner.plan: contents of a directory are
+        renamed before the directory itself, swaps and chains are resolved
+        and renames that would overwrite something are skipped."""
+        if not self.simulate and self.journal.exists():
+            return self.reject_actions(actions)
+        try:
+            return self.run_actions(actions)
+        finally:
+            self.journal.finish()
+
+    def reject_actions(self, actions):
+        if self.journal.locked():
+            reason = "another commit is running"
+            log.error("Another commit is running.")
+        else:
+            reason = "interrupted commit pending"
+            log.error("An interrupted commit has to be resumed or rolled "
+                      "back first.")
+        return [], [(src, dst, reason) for src, dst in actions]
+
+    def run_actions(self, actions):
+        """Plan renames, add them to the journal of the running commit and
+        carry them out. Returns (done, skipped) like commit_actions."""
+        with self.stats.timer("plan"):
+            actions, collisions = planner.plan(actions)
+        self.parked = planner.get_parked(actions)
+        for src, dst, reason in collisions:
+            log.warn("Skipping {} -> {} ({}).".format(src, dst, reason))
+
+        if self.simulate:
+            for i in actions:
+                log.debug("{} -> {}.".format(i[0], i[1]))
+            return actions, collisions
+
+        if self.journal.active:
+            self.journal.add(actions)
+        elif not self.journal.begin(actions):
+            return self.reject_actions(actions)
+        done = self.execute(actions)
+        return done, collisions + self.commitstats["failed"]
+
+    def commit_stream(self, batches):
+        """Commit batches of (source, destination) renames as they arrive
+        and yield (done, skipped) like commit_actions, about once every
+        streamsize renames. Unlike there, a swap or other cycle is reported
+        as the renames that were asked for, without the temporary names it
+        is carried out with. Each batch is a pair of lists, the renames of
+        files and those of directories, e.g. from PreviewTable.actions.
+
+        Batches are collected until streamsize renames are pending and then
+        planned, journaled and carried out together. A batch should hold
+        every rename of its directories, as planning can't resolve a chain
+        or swap that is split across two of them. Renames of directories
+        are held back and carried out after the last batch, deepest first,
+        so that the paths of later batches stay valid while the tree is
+        walked. All renames end up in one journal and one history commit.
+        Memory is bounded by streamsize, the largest batch and the number
+        of renamed directories."""
+        commitid, pending, dirs = None, [], []
+        rejected = not self.simulate and self.journal.exists()
+        try:
+            for batch in itertools.chain(batches, [None]):
+                if batch is None:
+                    # Flush what is left, then the directories.
+                    units, dirs = [pending, dirs], None
+                else:
+                    pending.extend(batch[0])
+                    dirs.extend(batch[1])
+                    if len(pending) < self.streamsize:
+                        continue
+                    units = [pending]
+                pending = []
+                for unit in units:
+                    if not unit or self.stopcommit:
+                        continue
+                    if rejected:
+                        yield self.reject_actions(unit)
+                        continue
+                    done, skipped = self.run_actions(unit)
+                    commitid = self.record_history(done, commitid)
+                    # Only the journal and history need the temporary names.
+                    yield (planner.unpark(done, self.parked),
+                           planner.unpark(skipped, self.parked))
+        finally:
+            self.journal.finish()
+        if self.stopcommit:
+            log.warn("Stopped commit, use undo to revert the finished "
+                     "renames.")
+
+    def execute(self, actions):
+        """Run planned renames and return the ones that succeeded.
+
+        Renames are grouped by parent directory. Directories at the same
+        depth are independent of each other and are processed concurrently
+        if workers > 1, one depth after the other starting with the deepest
+        so that contents are renamed before their directory."""
+        self.commitstats = {"done": 0, "errors": 0, "total": len(actions),
+                            "failed": [], "started": time.time(),
+                            "reported": time.time()}
+        levels = [[actions]]
+        local = all(os.path.dirname(src) == os.path.dirname(dst)
+                    for src, dst in actions)
+        if self.workers > 1 and local:
+            levels = self.group_actions(actions)
+        elif self.workers > 1:
+            log.info("Renames across directories, renaming serially.")
+
+        pool = None
+        if any(len(groups) > 1 for groups in levels):
+            pool = ThreadPool(self.workers)
+        done = []
+        try:
+            with self.stats.timer("commit"):
+                for groups in levels:
+                    if self.stopcommit:
+                        break
+                    if pool is not None and len(groups) > 1:
+                        results = pool.map(self.rename_group, groups, 1)
+                    else:
+                        results = [self.rename_group(g) for g in groups]
+                    for result in results:
+                        done.extend(result)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        stats = self.commitstats
+        if self.stats.enabled:
+            self.stats.count("renames", stats["done"])
+            self.stats.count("rename errors", stats["errors"])
+        elapsed = time.time() - stats["started"]
+        log.info("Renamed {} of {} targets in {:.1f}s ({:.0f} renames/s, {} "
+                 "errors).".format(stats["done"], stats["total"], elapsed,
+                                   stats["done"] / max(elapsed, 1e-6),
+                                   stats["errors"]))
+        return done
+
+    def group_actions(self, actions):
+        """Split planned renames into one list of directory groups per depth,
+        deepest first, keeping the planned order inside each group."""
+        depths = {}
+        for action in actions:
+            src = action[0]
+            groups = depths.setdefault(src.count("/"),
+                                       collections.OrderedDict())
+            groups.setdefault(os.path.dirname(src), []).append(action)
+        return [depths[d].values() for d in sorted(depths, reverse=True)]
+
+    def rename_group(self, actions):
+        done = []
+        for src, dst in actions:
             if self.stopcommit:
-                idx = actions.index(i)
-                log.warn("Stopping commit after {} renames." .format(idx + 1))
-                if idx:
-                    log.warn("Use undo to revert the rename actions.")
-                self.history.append(actions[:idx + 1])
-                return
+                break
+            log.debug("{} -> {}.".format(src, dst))
             try:
-                os.rename(i[0], i[1])
+                os.rename(src, dst)
             except Exception as e:
-                log.debug("Rename Error: {} -> {} ({}).".format(i[0], i[1], e))
+                log.debug("Rename Error: {} -> {} ({}).".format(src, dst, e))
+                with self.commitlock:
+                    self.commitstats["errors"] += 1
+                    self.commitstats["failed"].append((src, dst, str(e)))
                 if self.autostop:
+                    self.stopcommit = True
                     break
-
-        self.history.append(actions)
-        log.info("Renaming complete.")
+            else:
+                done.append((src, dst))
+                self.journal.record(src, dst)
+                self.report_progress()
+        return done
+
+    def report_progress(self):
+        """Count a finished rename and log the throughput every 2 seconds."""
+        with self.commitlock:
+            stats = self.commitstats
+            stats["done"] += 1
+            now = time.time()
+            if now - stats["reported"] < 2:
+                return
+            stats["reported"] = now
+            rate = stats["done"] / max(now - stats["started"], 1e-6)
+        log.info("Renamed {} of {} targets ({:.0f} renames/s).".format(
+                 stats["done"], stats["total"], rate))
+
+    def get_interrupted(self):
+        """Return (plan, done) of a commit that was interrupted by a crash,
+        or None if the last commit finished."""
+        return self.journal.load()
+
+    def resume(self):
+        """Carry out the remaining renames of an interrupted commit and
+        return them, without temporary names (see commit_stream). With
+        simulate, they are only returned and the journal is left as it
+        is."""
+        interrupted = self.get_interrupted()
+        if interrupted is None:
+            log.info("No interrupted commit to resume.")
+            return []
+        plan, done = interrupted
+        finished = set(done)
+        remaining = [i for i in plan if i not in finished]
+        log.info("Resuming commit with {} renames left.".format(len(remaining)))
+        parked = planner.get_parked(plan)
+        if self.simulate:
+            for i in remaining:
+                log.debug("{} -> {}.".format(i[0], i[1]))
+            return planner.unpark(remaining, parked)
+        if not self.journal.begin(plan):
+            return []
+        for src, dst in done:
+            self.journal.record(src, dst)
+        try:
+            resumed = self.execute(remaining)
+        finally:
+            self.journal.finish()
+        self.record_history(done + resumed)
+        return planner.unpark(resumed, parked)
+
+    def rollback(self):
+        """Revert the renames an interrupted commit managed to do."""
+        interrupted = self.get_interrupted()
+        if interrupted is None:
+            log.info("No interrupted commit to roll back.")
+            return
+        if not self.journal.acquire():
+            log.error("Another commit is running.")
+            return
+        log.info("Rolling back {} renames.".format(len(interrupted[1])))
+        try:
+            self.undo(interrupted[1])
+        finally:
+            if self.simulate:
+                self.journal.release()
+            else:
+                self.journal.finish()
+
+    def record_history(self, actions, commitid=None):
+        """Store finished renames as a new commit or, with commitid, add
+        them to that commit. Returns the id of the stored commit."""
+        if self.historystore is None or self.simulate:
+            # Batches of a stream are undone one at a time here.
+            self.history.append(actions)
+            return
+        if not actions:
+            return commitid
+        return self.historystore.add(actions, commitid=commitid)
+
+    def get_undo_conflicts(self, commitid):
+        """Return the paths that changed since a commit and keep it from
+        being undone. An empty list means it can be undone."""
+        store = self.historystore
+        conflicts = store.get_moved_since(commitid)
+        # Walk through the undo in advance. Every rename is reverted with
+        # the paths it was recorded with, but a renamed directory is only
+        # moved back later on, so its contents have to be looked up where
+        # the directory is right now. overlay holds what the undo itself
+        # will have created or vacated by then.
+        overlay, moved = {}, {}
+
+        def locate(path):
+            if path in moved:
+                return moved[path]
+            parent = path
+            while True:
+                pos = parent.rfind("/")
+                if pos <= 0:
+                    return path
+                parent = parent[:pos]
+                if parent in moved:
+                    return moved[parent] + path[len(parent):]
+
+        def exists(path):
+            if path in overlay:
+                return overlay[path]
+            return os.path.lexists(locate(path))
+
+        for src, dst in reversed(store.get_renames(commitid)):
+            if not exists(dst):
+                conflicts.append(dst)
+            elif exists(src):
+                conflicts.append(src)
+            else:
+                moved[src] = locate(dst)
+                overlay[dst], overlay[src] = False, True
+        return conflicts
+
+    def undo_commit(self, commitid=None):
+        """Revert a stored commit, the newest one by default. Fails if any
+        of its targets changed since."""
+        store = self.historystore
+        if commitid is None:
+            commitid = store.last()
+        commit = store.get_commit(commitid) if commitid is not None else None
+        if commit is None:
+            log.error("History is empty.")
+            return False
+        if commit[3]:
+            log.error("Commit {} was already undone.".format(commitid))
+            return False
+        conflicts = self.get_undo_conflicts(commitid)
+        if conflicts:
+            log.error("Can't undo commit {}, {} targets changed since, e.g. "
+                      "{}.".format(commitid, len(conflicts), conflicts[0]))
+            return False
+        log.info("Reverting commit {}.".format(commitid))
+        if not self.undo(store.get_renames(commitid)):
+            log.error("Commit {} was only partially undone.".format(commitid))
+            return False
+        store.set_undone(commitid)
+        return True
 
     def undo(self, actions=None):
         if actions is None:
+            if self.historystore is not None and not self.simulate:
+                return self.undo_commit()
             try:
                 actions = self.history.pop()
             except IndexError:
                 log.error("History list is empty.")
-                return
+                return False
 
-        for i in actions:
-            log.debug("{} -> {}.".format(i[1], i[0]))
-            if self.simulate:
-                continue
-            try:
-                os.rename(i[1], i[0])
-            except Exception as e:
-                log.error("Rename Error: {} -> {} ({}).".format(i[1], i[0], e))
-                if self.autostop:
-                    break
+        # Walk the commit backwards so that parked names and renamed
+        # directories are restored in the right order.
+        complete, errors = True, 0
+        with self.stats.timer("undo"):
+            for i in reversed(actions):
+                log.debug("{} -> {}.".format(i[1], i[0]))
+                if self.simulate:
+                    continue
+                try:
+                    os.rename(i[1], i[0])
+                except Exception as e:
+                    log.error("Rename Error: {} -> {} ({}).".format(i[1], i[0],
+                                                                   e))
+                    complete = False
+                    errors += 1
+                    if self.autostop:
+                        break
+        if self.stats.enabled and not self.simulate:
+            self.stats.count("undone", len(actions) - errors)
+            self.stats.count("undo errors", errors)
 
         log.info("Undo complete.")
-
-    def modify_previews(self, previews):
-        if self.countcheck:
-            lenp, base, step = len(previews), self.countbase, self.countstep
-            countlen = len(str(lenp))
-            countrange = xrange(base, lenp * step + 1, step)
-            if self.countfill:
-                count = (str(i).rjust(countlen, "0") for i in countrange)
-            else:
-                count = (str(i) for i in countrange)
-
-        modified = []
-        for preview in previews:
-            name = preview[1]
+        return complete
+
+    def get_counts(self, targets, rows=None):
+        """Return the counter strings of a TargetTable in target order, or
+        only those of the given rows, e.g. to transform a few of them.
+
+        Counters are assigned by rank (see TargetTable.get_ranks), which is
+        computed once per target list and sort mode. With countdirs, every
+        directory is counted on its own. The fill pads all counters to the
+        width of the last one, which with countdirs is the last one of the
+        largest directory."""
+        base, step = self.countbase, self.countstep
+        ranks = targets.get_ranks(self.sortmode, self.countdirs)
+        if self.countdirs:
+            # Number of targets in the largest directory.
+            total = max(ranks) + 1 if ranks else 0
+        else:
+            total = len(targets)
+        last = base + (total - 1) * step
+        countlen = len(str(last)) if self.countfill else 0
+        if rows is not None:
+            return [str(base + ranks[r] * step).rjust(countlen, "0")
+                    for r in rows]
+        counts = [str(i).rjust(countlen, "0")
+                  for i in xrange(base, last + 1, step)]
+        return map(counts.__getitem__, ranks)
+
+    def get_stages(self):
+        """Return the transform stages in pipeline order, each as a tuple of
+        (name, enabled, options). A stage only has to be rerun if its own
+        options or those of an earlier stage have changed."""
+        return [("base", True, (self.remext, self.keepext)),
+                ("case", self.casecheck, (self.casemode,)),
+                ("space", self.spacecheck, (self.spacemode,)),
+                ("delete", self.deletecheck, (self.deletestart,
+                                              self.deleteend)),
+                ("remove", self.removecheck, (self.remnonwords,
+                                              self.remsymbols, self.remdups,
+                                              self.ignorecase)),
+                ("insert", self.insertcheck, (self.insertedit,
+                                              self.insertpos)),
+                ("replace", self.matchcheck, (self.matchreplacecheck,
+                                              self.matchedit,
+                                              self.replaceedit, self.regex,
+                                              self.ignorecase)),
+                ("count", self.countcheck, (self.countpos, self.countbase,
+                                            self.countstep, self.countfill,
+                                            self.countpreedit,
+                                            self.countsufedit, self.sortmode,
+                                            self.countdirs)),
+                ("ext", self.keepext, ())]
+
+    def run_stage(self, stage, names, previews, counts, stoppable=True):
+        """Apply a single transform stage to a list of names."""
+        if stage == "base":
             if not self.remext and not self.keepext:
-                name += preview[2]
-            if self.casecheck:
-                name = self.apply_case(name)
-            if self.spacecheck:
-                name = self.apply_space(name)
-            if self.deletecheck:
-                name = self.apply_delete(name)
-            if self.removecheck:
-                name = self.apply_remove(name)
-            if self.insertcheck:
-                name = self.apply_insert(name)
-            if self.matchcheck:
-                name = self.apply_replace(name)
-            if self.countcheck:
-                try:
-                    name = self.apply_count(name, count.next())
-                except StopIteration:
-                    pass
-
-            if self.keepext:
-                name += preview[2]
+                return list(previews.filenames)
+            return previews.names()
+        elif stage == "count":
+            return self.batch_count(names, counts)
+        elif stage == "ext":
+            return [n + e for n, e in izip(names, previews.exts())]
+        func = getattr(self, "batch_" + stage)
+        # Work in blocks so that a cancelled update stops quickly.
+        modified, blocksize = [], self.blocksize
+        for i in xrange(0, len(names), blocksize):
+            if stoppable and self.stopupdate:
+                return
+            modified.extend(func(names[i:i + blocksize]))
+        return modified
 
-            preview = ((preview[0], preview[1] + preview[2]), name)
-            modified.append(preview)
+    def clear_stages(self):
+        self.stagecache = {"previews": None, "length": 0, "stages": []}
+
+    def modify_previews(self, previews, counts=None, parallel=True,
+                        cache=True, stoppable=True):
+        """Apply all enabled transforms to the TargetTable previews and return
+        a PreviewTable. counts can be used to pass in the counter strings of
+        a slice of a larger target list.
+
+        The output of every stage is cached for the last list of previews
+        so that changing a late stage (e.g. replace) only reruns that stage
+        and the ones after it. Use cache=False for small one-off lists that
+        should not replace the cached stages. Returns None if stopupdate is
+        set while the transforms are running, unless stoppable is False
+        (e.g. for previews that are about to be committed)."""
+        usecache = cache and counts is None
+        if self.countcheck and counts is None:
+            counts = self.get_counts(previews)
+
+        if (parallel and self.processes > 1 and
+                len(previews) >= self.processthreshold):
+            return self.modify_previews_parallel(previews, counts)
+
+        cache = self.stagecache
+        if not usecache or cache["previews"] is not previews or\
+           cache["length"] != len(previews):
+            cache = {"previews": previews, "length": len(previews),
+                     "stages": []}
+        cached, stages = cache["stages"], []
+        names = None
+        for idx, (stage, enabled, options) in enumerate(self.get_stages()):
+            signature = (enabled, options if enabled else None)
+            if idx < len(cached) and cached[idx][0] == signature:
+                names = cached[idx][1]
+            else:
+                # Everything after a changed stage has to be rerun, too.
+                del cached[idx:]
+                if stoppable and self.stopupdate:
+                    return
+                if enabled:
+                    with self.stats.timer("stage " + stage):
+                        names = self.run_stage(stage, names, previews, counts,
+                                               stoppable)
+                    if names is None:
+                        return
+            stages.append((signature, names))
+        if usecache:
+            cache["stages"] = stages
+            self.stagecache = cache
+
+        return PreviewTable(previews, names)
+
+    def modify_previews_parallel(self, previews, counts=None):
+        """Split previews into chunks and transform them in worker processes.
+
+        The counters are assigned up front and handed out with each chunk,
+        so the result is identical to the serial path."""
+        lenp = len(previews)
+        chunksize = lenp // (self.processes * 4) + 1
+        chunks = []
+        for i in xrange(0, lenp, chunksize):
+            chunkcounts = counts[i:i + chunksize] if counts is not None else None
+            chunks.append((previews[i:i + chunksize], chunkcounts))
+
+        # The workers are forked from this instance to inherit its options.
+        pool = multiprocessing.Pool(self.processes, _init_worker, (self,))
+        try:
+            results = pool.map(_modify_chunk, chunks)
+        finally:
+            pool.terminate()
 
-        return modified
+        return PreviewTable(previews, [n for names in results for n in names])
 
     def apply_space(self, s):
         if not self.spacecheck:
             return s
 
-        if self.spacemode == 0:
-            s = s.replace(" ", "_")
-        elif self.spacemode == 1:
-            s = s.replace(" ", "-")
-        elif self.spacemode == 2:
-            s = s.replace(" ", ".")
-        elif self.spacemode == 3:
-            s = s.replace(".", " ")
-        elif self.spacemode == 4:
-            s = s.replace("-", " ")
-        elif self.spacemode == 5:
-            s = s.replace("_", " ")
+        if self.spacemode in SPACEMODES:
+            s = s.replace(*SPACEMODES[self.spacemode])
         elif self.spacemode == 6:
-            s = re.sub("[.\s]", "_", s)
+            s = spacerx.sub("_", s)
 
         return s
 
@@ -372,38 +966,119 @@ class FileOps(object):
         if self.remnonwords:
             s = re.sub("\W", "", s, flags=self.ignorecase)
         if self.remsymbols:
-            allowed = string.ascii_letters + string.digits + " .-_+"  # []()
-            for i in ["utf-8", "latin1"]:
-                try:
-                    # Convert bytestring to unicode and back.
-                    s = "".join(c for c in normalize("NFKD", s.decode(i))
-                                if c in allowed).encode("utf-8")
-                    break
-                except UnicodeDecodeError:
-                    pass
-            else:
-                log.debug("Symbols: Could not decode {}.".format(s))
+            s = self.remove_symbols(s)
         if self.remdups:
-            s = re.sub(r"([-_ .])\1+", r"\1", s, flags=self.ignorecase)
+            s = duplicaterx.sub(r"\1", s)
         return s
 
+    def remove_symbols(self, s):
+        if isinstance(s, unicode):
+            return s.translate(self.symboltable).encode("utf-8")
+        for i in ["utf-8", "latin1"]:
+            try:
+                # Convert bytestring to unicode and back.
+                return s.decode(i).translate(self.symboltable).encode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        log.debug("Symbols: Could not decode {}.".format(s))
+        return s
+
+    def remove_symbols_joined(self, names):
+        """Column version of remove_symbols, translating all names at once
+        unless one of them isn't valid utf-8."""
+        table = self.symboltable
+        try:
+            return helpers.apply_joined(names, lambda s: s.decode("utf-8")
+                                        .translate(table).encode("utf-8"))
+        except UnicodeError:
+            return map(self.remove_symbols, names)
+
     def apply_replace(self, s):
         if not self.matchreplacecheck or not self.matchedit:
             return s
 
-        if not self.regex:
-            matchpat = fnmatch.translate(self.matchedit)
-            replacepat = helpers.translate(self.replaceedit)
-        else:
-            matchpat = self.matchedit
-            replacepat = self.replaceedit
+        patterns = self.get_patterns("matchedit")
+        if patterns is None:
+            return s
         try:
-            s = re.sub(matchpat, replacepat, s, flags=self.ignorecase)
+            s = patterns[0].sub(patterns[1], s)
         except:
             pass
 
         return s
 
+    # Column versions of the transforms. Each takes a list of names and
+    # returns the list of results, doing as much as possible in single calls
+    # over all names instead of one call per name.
+
+    def batch_space(self, names):
+        if self.spacemode in SPACEMODES:
+            func = methodcaller("replace", *SPACEMODES[self.spacemode])
+        elif self.spacemode == 6:
+            func = partial(spacerx.sub, "_")
+        else:
+            return names
+        try:
+            return helpers.apply_joined(names, func)
+        except UnicodeError:
+            return [self.apply_space(s) for s in names]
+
+    def batch_case(self, names):
+        try:
+            if self.casemode == 0:
+                return helpers.apply_joined(names, methodcaller("lower"))
+            elif self.casemode == 1:
+                return helpers.apply_joined(names, methodcaller("upper"))
+        except UnicodeError:
+            pass
+        if self.casemode == 2:
+            return map(methodcaller("capitalize"), names)
+        return [self.apply_case(s) for s in names]
+
+    def batch_delete(self, names):
+        start, end = self.deletestart, self.deleteend
+        return [s[:start] + s[end:] for s in names]
+
+    def batch_count(self, names, counts):
+        """Insert the counter strings into names."""
+        pre, suf = self.countpreedit or "", self.countsufedit or ""
+        pos = self.countpos
+        # Same positions as list.insert in apply_count.
+        return [s[:pos] + pre + c + suf + s[pos:]
+                for s, c in izip(names, counts)]
+
+    def batch_insert(self, names):
+        if not self.insertedit:
+            return names
+        # Same positions as list.insert, including negative ones.
+        pos, text = self.insertpos, self.insertedit
+        return [s[:pos] + text + s[pos:] for s in names]
+
+    def batch_remove(self, names):
+        try:
+            if self.remnonwords:
+                names = helpers.apply_joined(names, partial(nonwordrx.sub, ""))
+            if self.remsymbols:
+                names = self.remove_symbols_joined(names)
+            if self.remdups:
+                names = helpers.apply_joined(names,
+                                             partial(duplicaterx.sub, r"\1"))
+        except UnicodeError:
+            return [self.apply_remove(s) for s in names]
+        return names
+
+    def batch_replace(self, names):
+        if not self.matchreplacecheck or not self.matchedit:
+            return names
+        patterns = self.get_patterns("matchedit")
+        if patterns is None:
+            return names
+        sub = partial(patterns[0].sub, patterns[1])
+        try:
+            return map(sub, names)
+        except Exception:
+            return [self.apply_replace(s) for s in names]
+
     @property
     def dirsonly(self):
         return self._dirsonly
@@ -444,6 +1119,36 @@ class FileOps(object):
         log.debug("recursivedepth: {}".format(num))
         self._recursivedepth = num
 
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, num):
+        log.debug("workers: {}".format(num))
+        self._workers = num
+
+    @property
+    def processes(self):
+        return self._processes
+
+    @processes.setter
+    def processes(self, num):
+        log.debug("processes: {}".format(num))
+        self._processes = num
+
+    @property
+    def cache(self):
+        return self.listingcache is not None
+
+    @cache.setter
+    def cache(self, boolean):
+        log.debug("cache: {}".format(boolean))
+        if boolean and self.listingcache is None:
+            self.listingcache = listcache.ListingCache(self.configdir)
+        elif not boolean:
+            self.listingcache = None
+
     @property
     def hidden(self):
         return self._hidden
@@ -497,6 +1202,7 @@ class FileOps(object):
     def regex(self, boolean):
         log.debug("regex: {}.".format(boolean))
         self._regex = boolean
+        self.clear_patterns()
 
     @property
     def varcheck(self):
@@ -577,6 +1283,7 @@ class FileOps(object):
     def matchedit(self, text):
         log.debug("matchedit: {}.".format(text))
         self._matchedit = text
+        self.clear_patterns()
 
     @property
     def replaceedit(self):
@@ -586,6 +1293,7 @@ class FileOps(object):
     def replaceedit(self, text):
         log.debug("replaceedit: {}.".format(text))
         self._replaceedit = text
+        self.clear_patterns()
 
     @property
     def filteredit(self):
@@ -595,6 +1303,7 @@ class FileOps(object):
     def filteredit(self, text):
         log.debug("filteredit: {}.".format(text))
         self._filteredit = text
+        self.clear_patterns()
 
     @property
     def excludeedit(self):
@@ -604,6 +1313,7 @@ class FileOps(object):
     def excludeedit(self, text):
         log.debug("excludeedit: {}.".format(text))
         self._excludeedit = text
+        self.clear_patterns()
 
     @property
     def remsymbols(self):
@@ -679,6 +1389,7 @@ class FileOps(object):
             flag = re.I
         log.debug("ignorecase: {}".format(boolean))
         self._ignorecase = flag
+        self.clear_patterns()
 
     @property
     def mediamode(self):
@@ -707,6 +1418,24 @@ class FileOps(object):
         log.debug("countfill: {}".format(boolean))
         self._countfill = boolean
 
+    @property
+    def countdirs(self):
+        return self._countdirs
+
+    @countdirs.setter
+    def countdirs(self, boolean):
+        log.debug("countdirs: {}".format(boolean))
+        self._countdirs = boolean
+
+    @property
+    def sortmode(self):
+        return self._sortmode
+
+    @sortmode.setter
+    def sortmode(self, num):
+        log.debug("sortmode: {}".format(num))
+        self._sortmode = num
+
     @property
     def countpos(self):
         return self._countpos
@@ -12,7 +12,6 @@ Options:
     --version            Show the current demimove-ui version.
 """
 # GUI:
-# TODO: Overwrite check.
 # TODO: Accelerators (C+Q, Q+S).
 # TODO: Add recursive include/exclude in contextmenu.
 # TODO: Test QDirIterator vs os.path.walk. If positive, replace get_targets
@@ -23,23 +22,25 @@ Options:
 # TODO: Test demimove on windows?
 # TODO: Write unittests for rename/undo with mock unicode input?
 # Fileops:
-# TODO: Fix count step and count base plus large listings (~i).
 # TODO: Enable glob replacing like this: *.mp3 prefix*.mp3
 #       (Adjust translate method to group wildcards).
 # TODO: Fix filters on hiddencheck? Logic for on_refreshbutton?
 # TODO: (more) fallback encodings?
 # TODO: grey out undo button if history empty
 
-import codecs
+import collections
 import logging
 import os
 import sys
+import time
 
 from PyQt4 import Qt, QtGui, QtCore, uic
 
 import fileops
 import helpers
+from targets import LazyPreviewTable, PreviewTable, TargetTable
 import history
+import watcher
 
 
 log = logging.getLogger("gui")
@@ -89,27 +90,49 @@ class DirModel(QtGui.QFileSystemModel):
             return
         if not self.p.fileops.recursive and index.parent() != self.p.cwdidx:
             return
-        target = helpers.splitpath_os(self.p.get_path(index))
-        if self.p.cwd in target[0] and target in self.p.targets:
-            idx = self.p.targets.index(target)
-            try:
-                # If preview differs from its original name, show the preview.
-                if target[1] + target[2] != self.p.previews[idx][1]:
-                    for i in ["utf-8", "latin1"]:
-                        try:
-                            return self.p.previews[idx][1].decode(i)
-                        except UnicodeDecodeError:
-                            pass
-                    return self.p.previews[idx][1]
-                # Otherwise show "\1" to indicate that nothing changed.
-                else:
-                    return "\\1"
-            except IndexError:
-                return "err"
+        # The index is keyed by the full path, so neither a split nor a stat
+        # of the path is needed here.
+        path = self.p.get_path(index)
+        if not path.startswith(self.p.cwd):
+            return
+        # Indexed lookups instead of scanning the targets list per cell.
+        # Previews can lag behind the targets until they are recomputed.
+        if self.p.targets.find(path) is None:
+            return
+        previews = self.p.previews
+        if isinstance(previews, LazyPreviewTable):
+            # Prefetch the previews of the rows that are painted next.
+            preview = previews.find(path, lambda before, after:
+                                    self.nearby_paths(index, before, after))
+        else:
+            preview = previews.find(path)
+        if preview is None:
+            return
+        # If preview differs from its original name, show the preview.
+        if os.path.basename(path) != preview:
+            for i in ["utf-8", "latin1"]:
+                try:
+                    return preview.decode(i)
+                except UnicodeDecodeError:
+                    pass
+            return preview
+        # Otherwise show "\1" to indicate that nothing changed.
+        else:
+            return "\\1"
+
+    def nearby_paths(self, index, before, after):
+        """Return the paths of the rows around index in view order."""
+        parent, row = index.parent(), index.row()
+        stop = min(self.rowCount(parent), row + after)
+        return [self.p.get_path(self.index(r, 0, parent))
+                for r in xrange(max(0, row - before), stop)]
 
 
 class UpdateThread(QtCore.QThread):
 
+    # Emitted whenever a streamed batch of previews has been published.
+    batchready = QtCore.pyqtSignal()
+
     def __init__(self, parent=None):
         super(UpdateThread, self).__init__(parent)
         self.p = parent
@@ -121,8 +144,7 @@ class UpdateThread(QtCore.QThread):
         elif self.mode == 1:
             self.p.update_previews()
         elif self.mode == 2:
-            self.p.update_targets()
-            self.p.update_previews()
+            self.p.stream_previews(self.batchready)
 
 
 class CommitThread(QtCore.QThread):
@@ -132,7 +154,11 @@ class CommitThread(QtCore.QThread):
         self.p = parent
 
     def run(self):
-        self.p.fileops.commit(self.p.previews)
+        previews = self.p.previews
+        if isinstance(previews, LazyPreviewTable):
+            # Not stopped by a cancelled update, see resolve.
+            previews = previews.resolve()
+        self.p.fileops.commit(previews)
 
 
 class DemiMoveGUI(QtGui.QMainWindow):
@@ -144,18 +170,30 @@ class DemiMoveGUI(QtGui.QMainWindow):
         # Current working directory.
         self.basedir = os.path.dirname(os.path.realpath(__file__))
         self._autopreview = True
+        # Only transform the targets the view asks for.
+        self.lazypreviews = False
         self._cwd = ""
         self._cwdidx = None
         self.switchview = False
         # Initialize empty containers for option states and targets.
         self.dualoptions1, self.dualoptions2 = {}, {}
-        self.targets, self.joinedtargets = [], []
-        self.previews = []
+        self.previews = PreviewTable()
+        self.targets = self.previews.targets
 
         self.initialize_ui(startdir, configfile)
 
     def initialize_ui(self, startdir, configfile):
         self.updatethread = UpdateThread(self)
+        # Coalesces bursts of option changes into a single update.
+        self.pendingmode = None
+        self.updatetimer = QtCore.QTimer(self)
+        self.updatetimer.setSingleShot(True)
+        self.updatetimer.setInterval(150)
+        # Patches targets with filesystem changes instead of rescanning.
+        self.watcher = watcher.Watcher()
+        self.watchroots = None
+        self.watchtimer = QtCore.QTimer(self)
+        self.watchtimer.setInterval(1000)
         self.committhread = CommitThread(self)
         guifile = os.path.join(self.basedir, "data/gui.ui")
         iconfile = os.path.join(self.basedir, "data/icon.png")
@@ -164,7 +202,7 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.setWindowIcon(QtGui.QIcon(iconfile))
         self.mainsplitter.setStretchFactor(0, 1)
         self.create_browser(startdir)
-#         self.create_historytab()
+        self.create_historytab()
         self.connect_elements()
 
         self.startoptions, self.defaultoptions = helpers.load_configfile(
@@ -177,6 +215,7 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.mediaboxes = [self.casebox, self.spacebox]
 
         self.dirview.setExpanded(self.get_index(), True)
+        self.check_journal()
         log.info("demimove-ui initialized.")
         self.statusbar.showMessage("Select a directory and press Enter.")
 
@@ -202,19 +241,19 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.dirview.setCurrentIndex(self.dirmodel.index(startdir))
 
     def create_historytab(self):
-        historyfile = os.path.join(self.fileops.configdir, "history.txt")
-
-        try:
-            with codecs.open(historyfile, encoding="utf-8") as f:
-                data = f.read()
-        except IOError:
-            historyfile = os.path.join(self.basedir, "data/history.txt")
-            with codecs.open(historyfile, encoding="utf-8") as f:
-                data = f.read()
-
-        self.historymodel = history.HistoryTreeModel(data, self)
+        self.historymodel = history.HistoryTreeModel(self.fileops.historystore,
+                                                     self)
         self.historytree.setModel(self.historymodel)
 
+    def get_selected_commit(self):
+        """Return the id of the commit selected in the history tab."""
+        if self.treewidget.currentWidget() != self.historytab:
+            return
+        index = self.historytree.currentIndex()
+        if not index.isValid():
+            return
+        return self.historymodel.get_commitid(index)
+
     def set_options(self, options=None, sanitize=False):
         if not options:
             options = self.defaultoptions
@@ -270,12 +309,33 @@ class DemiMoveGUI(QtGui.QMainWindow):
             self.dirview.setExpanded(self.cwdidx, True)
             self.update(2)
         elif self.cwd and path == self.cwd:
-            self.fileops.stopupdate = True
+            self.cancel_update()
+            self.watcher.clear()
             self.dirview.setExpanded(self.cwdidx, False)
             self.cwd = ""
             self.cwdidx = None
             self.update_indexview()
 
+    def check_journal(self):
+        """Offer to resume or roll back a commit that was interrupted."""
+        interrupted = self.fileops.get_interrupted()
+        if interrupted is None:
+            return
+        plan, done = interrupted
+        m = QtGui.QMessageBox(self)
+        m.setWindowTitle("Interrupted commit")
+        m.setText("The last commit was interrupted after {} of {} renames."
+                  .format(len(done), len(plan)))
+        m.setInformativeText("Resume it or roll back the finished renames?")
+        resume = m.addButton("Resume", m.AcceptRole)
+        rollback = m.addButton("Roll back", m.DestructiveRole)
+        m.addButton("Later", m.RejectRole)
+        m.exec_()
+        if m.clickedButton() == resume:
+            self.fileops.resume()
+        elif m.clickedButton() == rollback:
+            self.fileops.rollback()
+
     def delete_index(self, indexes=None):
         if not indexes:
             indexes = self.get_selected_indexes()
@@ -310,10 +370,9 @@ class DemiMoveGUI(QtGui.QMainWindow):
         indexes = self.get_selected_indexes()
         for idx in indexes:
             path = self.get_path(idx)
-            target = helpers.splitpath_os(path)
-            name = target[1] + target[2]
+            name = os.path.basename(path)
             if mode == 0:  # Toggle Include/Exclude
-                if target in self.targets:
+                if self.targets.find(path) is not None:
                     self.fileops.includes.discard(name)
                     self.fileops.excludes.add(name)
                 else:
@@ -369,13 +428,44 @@ class DemiMoveGUI(QtGui.QMainWindow):
             self.delete_index()
 
     def update(self, mode=1):
-        """Main update routine using threading to get targets and/or previews"""
+        """Main update routine using threading to get targets and/or previews.
+
+        Requests are debounced: a burst of option changes results in a single
+        update with the combined mode. A running update is cancelled so that
+        the newest options are always the ones shown."""
         # Modes: 0 = targets, 1 = previews, 2 = both.
-        self.fileops.stopupdate = False
         if not self.autopreview or not self.cwd:
             self.update_view()
             return
-        self.updatethread.mode = mode
+        self.pendingmode = self.merge_modes(self.pendingmode, mode)
+        if self.updatethread.isRunning():
+            # Rerun whatever the cancelled update did not get to finish.
+            self.pendingmode = self.merge_modes(self.pendingmode,
+                                                self.updatethread.mode)
+            self.fileops.stopupdate = True
+        self.updatetimer.start()
+
+    def cancel_update(self):
+        """Stop the running update and drop pending ones."""
+        self.updatetimer.stop()
+        self.pendingmode = None
+        # on_updatethread_finished clears the flag again, so only set it
+        # while there is an update to stop.
+        if self.updatethread.isRunning():
+            self.fileops.stopupdate = True
+
+    def merge_modes(self, mode, other):
+        if mode is None or mode == other:
+            return other
+        return 2
+
+    def start_update(self):
+        """Start the pending update, unless one is still running. In that
+        case it is started from on_updatethread_finished."""
+        if self.pendingmode is None or self.updatethread.isRunning():
+            return
+        self.fileops.stopupdate = False
+        self.updatethread.mode, self.pendingmode = self.pendingmode, None
         self.updatethread.start()
 
     def on_updatethread_started(self):
@@ -386,26 +476,220 @@ class DemiMoveGUI(QtGui.QMainWindow):
     def on_updatethread_finished(self):
         log.debug("Updatethread finished.")
         self.refreshbutton.setText("Refresh")
-        if self.cwd:
+        # The cancel, if any, has been handled.
+        self.fileops.stopupdate = False
+        if self.watchroots is not None:
+            if self.cwd:
+                self.rewatch(self.watchroots)
+            self.watchroots = None
+        if self.pendingmode is not None and not self.updatetimer.isActive():
+            self.start_update()
+            return
+        self.show_status()
+        self.show_stats()
+        self.update_view()
+
+    def show_status(self):
+        if self.cwd and isinstance(self.previews, LazyPreviewTable):
+            self.statusbar.showMessage("Targets: {}, Staged: counted on commit "
+                                       "- {}".format(len(self.targets),
+                                                     self.cwd))
+        elif self.cwd:
             lent = len(self.targets)
-            lenp = sum(i[0][1] != i[1] for i in self.previews)
+            lenp = self.previews.count_changed()
             self.statusbar.showMessage("Targets: {}, Staged: {} - {}"
                                    .format(lent, lenp, self.cwd))
         else:
             self.statusbar.showMessage("No working directory set.")
-        self.update_view()
+
+    def show_stats(self):
+        stats = self.fileops.stats
+        if stats.enabled:
+            self.statsview.setPlainText("\n".join(stats.format()))
 
     def update_targets(self):
+        roots = []
         if self.cwd:
-            self.targets = self.fileops.get_targets(self.cwd)
+            targets = self.fileops.get_targets(self.cwd, roots)
         else:
-            self.targets = []
+            targets = TargetTable()
+        if not self.fileops.stopupdate:
+            self.watchroots = roots
+        # Index here instead of on the first lookup from the view. Previews
+        # of targets that are still around stay visible until recomputed.
+        targets.build_index()
+        self.targets = targets
 
     def update_previews(self):
-        if self.cwd:
-            self.previews = self.fileops.get_previews(self.targets)
+        if self.cwd and self.lazypreviews:
+            previews = LazyPreviewTable(self.fileops, self.targets)
+        elif self.cwd:
+            targets = self.targets
+            previews = self.fileops.get_previews(targets)
+            if previews is None:
+                # Cancelled, a newer update takes over from here.
+                return
         else:
-            self.previews = []
+            previews = PreviewTable()
+        if previews.targets.lookup is None:
+            # update_targets indexed the targets already, appends keep the
+            # index up to date.
+            previews.targets.build_index()
+        self.previews = previews
+
+    def stream_previews(self, batchready=None):
+        """Walk cwd and publish targets and previews per directory, so the
+        first previews show up before the whole tree has been walked."""
+        previews = PreviewTable()
+        previews.targets.build_index()
+        self.targets, self.previews = previews.targets, previews
+        if not self.cwd:
+            return
+        roots = []
+        batches = self.fileops.iter_targets(self.cwd, roots)
+        if self.lazypreviews:
+            self.stream_targets(batches, batchready)
+            if not self.fileops.stopupdate:
+                self.watchroots = roots
+            return
+        lastemit = time.time()
+        for batch, batchpreviews in self.fileops.iter_previews(batches):
+            previews.extend(batchpreviews)
+            # Throttle view refreshes for trees with many small directories.
+            if batchready is not None and time.time() - lastemit > 0.2:
+                lastemit = time.time()
+                batchready.emit()
+        if not self.fileops.stopupdate:
+            self.watchroots = roots
+
+    def stream_targets(self, batches, batchready=None):
+        """Publish the targets per directory and leave their previews to the
+        view. Counters need the ranks of all targets, so with countcheck
+        previews only show up once the walk is done."""
+        fileops = self.fileops
+        targets = TargetTable()
+        targets.build_index()
+        self.targets = targets
+        if not fileops.countcheck:
+            self.previews = LazyPreviewTable(fileops, targets)
+        lastemit = time.time()
+        for batch in batches:
+            targets.extend(batch)
+            if batchready is not None and time.time() - lastemit > 0.2:
+                lastemit = time.time()
+                batchready.emit()
+        if fileops.countcheck and not fileops.stopupdate:
+            self.previews = LazyPreviewTable(fileops,
+                                             fileops.sort_targets(targets))
+
+    def rewatch(self, roots):
+        """Watch the directories of the last full scan for changes."""
+        self.watcher.clear()
+        self.watcher.levels = 0
+        if self.fileops.recursive:
+            self.watcher.levels = self.fileops.recursivedepth
+        cwdlevel = self.cwd.rstrip("/").count("/")
+        for root in roots:
+            self.watcher.watch(root, root.rstrip("/").count("/") - cwdlevel)
+
+    def on_watchtimer(self):
+        """Apply filesystem changes picked up by the watcher."""
+        if self.committhread.isRunning():
+            self.show_commitprogress()
+            return
+        if not self.cwd or self.updatethread.isRunning():
+            return
+        events = self.watcher.poll()
+        if events:
+            self.apply_events(events)
+
+    def show_commitprogress(self):
+        stats = self.fileops.commitstats
+        if not stats:
+            return
+        elapsed = max(time.time() - stats["started"], 1e-6)
+        self.statusbar.showMessage("Renamed {} of {} ({:.0f}/s).".format(
+                                   stats["done"], stats["total"],
+                                   stats["done"] / elapsed))
+
+    def refresh_changes(self):
+        """Pick up changes after a commit or undo, through the watcher if it
+        sees all of them right away and with a full rescan otherwise. A
+        polling watcher only gets to every directory over time."""
+        watcher = self.watcher
+        if watcher.watching and watcher.complete and \
+           watcher.mode == "inotify":
+            self.on_watchtimer()
+        else:
+            self.update(2)
+
+    def apply_events(self, events):
+        """Patch targets, previews and the preview index with watcher events
+        instead of rescanning the whole tree."""
+        fileops = self.fileops
+        changed, prefixes = collections.OrderedDict(), []
+        for kind, root, name, isdir in events:
+            if kind == "overflow":
+                self.update(2)
+                return
+            path = root + name
+            changed.pop(path, None)
+            changed[path] = (kind, root, name, isdir)
+            if kind == "delete" and isdir:
+                # Everything that was below the directory is gone as well.
+                prefix = path + "/"
+                prefixes.append(prefix)
+                for p in [p for p in changed if p.startswith(prefix)]:
+                    del changed[p]
+
+        new = TargetTable()
+        for kind, root, name, isdir in changed.values():
+            if kind != "create" or not fileops.match(name):
+                continue
+            if isdir and not fileops.filesonly:
+                new.add_dirs(root, [name])
+            elif not isdir and not fileops.dirsonly:
+                new.add_files(root, [name])
+
+        targets, previews = self.targets, self.previews
+        shared = previews.targets is targets
+        prefixes = tuple(prefixes)
+        removed = set(p for p in changed if targets.find(p) is not None)
+        if removed or prefixes:
+            keep = lambda table: [i for i, p in enumerate(table.paths()) if
+                                  p not in removed and
+                                  not p.startswith(prefixes)]
+            previews = previews.select(keep(previews.targets))
+            targets = previews.targets if shared else targets.select(
+                                                      keep(targets))
+        elif not new:
+            return
+        log.debug("Watcher: {} new, {} removed targets.".format(
+                  len(new), len(self.targets) - len(targets)))
+
+        if fileops.countcheck:
+            # Counters depend on the position of every target, so only the
+            # walk can be skipped here.
+            merged = TargetTable()
+            merged.extend(targets)
+            merged.extend(new)
+            self.targets, self.previews = fileops.sort_targets(merged), previews
+            self.update(1)
+            return
+
+        # The watcher runs between updates, so a cancel of the last one
+        # must not stop this.
+        newpreviews = fileops.modify_previews(new, cache=False,
+                                              stoppable=False)
+        if newpreviews is None:
+            self.update(2)
+            return
+        if not shared:
+            targets.extend(new)
+        previews.extend(newpreviews)
+        self.targets, self.previews = targets, previews
+        self.show_status()
+        self.update_view()
 
     def update_view(self):
         m, v = self.dirmodel, self.dirview
@@ -426,12 +710,18 @@ class DemiMoveGUI(QtGui.QMainWindow):
     def on_committhread_finished(self):
         log.debug("Committhread finished.")
         self.commitbutton.setText("Commit")
-        self.update(2)
+        self.refresh_changes()
+        self.create_historytab()
+        self.show_stats()
 
     def connect_elements(self):
         self.dirview.customContextMenuRequested.connect(self.on_popmenu)
         self.updatethread.finished.connect(self.on_updatethread_finished)
         self.updatethread.started.connect(self.on_updatethread_started)
+        self.updatethread.batchready.connect(self.update_view)
+        self.updatetimer.timeout.connect(self.start_update)
+        self.watchtimer.timeout.connect(self.on_watchtimer)
+        self.watchtimer.start()
         self.committhread.finished.connect(self.on_committhread_finished)
         self.committhread.started.connect(self.on_committhread_started)
 
@@ -447,11 +737,16 @@ class DemiMoveGUI(QtGui.QMainWindow):
         # Main options:
         self.autopreviewcheck.toggled.connect(self.on_autopreviewcheck)
         self.autostopcheck.toggled.connect(self.on_autostopcheck)
+        self.cachecheck.toggled.connect(self.on_cachecheck)
+        self.lazycheck.toggled.connect(self.on_lazycheck)
+        self.statscheck.toggled.connect(self.on_statscheck)
+        self.statsresetbutton.clicked.connect(self.on_statsresetbutton)
         self.keepextensionscheck.toggled.connect(self.on_keepextensioncheck)
         self.hiddencheck.toggled.connect(self.on_hiddencheck)
         self.manualmirrorcheck.toggled.connect(self.on_manualmirrorcheck)
         self.recursivecheck.toggled.connect(self.on_recursivecheck)
         self.recursivedepth.valueChanged.connect(self.on_recursivedepth)
+        self.workers.valueChanged.connect(self.on_workers)
         self.saveoptionsbutton.clicked.connect(self.on_saveoptionsbutton)
         self.restoreoptionsbutton.clicked.connect(self.on_restoreoptionsbutton)
         self.clearoptionsbutton.clicked.connect(self.on_clearoptionsbutton)
@@ -487,6 +782,7 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.countpreedit.textChanged.connect(self.on_countpreedit)
         self.countsufedit.textChanged.connect(self.on_countsufedit)
         self.countfillcheck.toggled.connect(self.on_countfillcheck)
+        self.countdircheck.toggled.connect(self.on_countdircheck)
 
         # Remove options:
         self.removecheck.toggled.connect(self.on_removecheck)
@@ -499,6 +795,7 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.casebox.currentIndexChanged[int].connect(self.on_casebox)
         self.spacecheck.toggled.connect(self.on_spacecheck)
         self.spacebox.currentIndexChanged[int].connect(self.on_spacebox)
+        self.sortbox.currentIndexChanged[int].connect(self.on_sortbox)
 
         self.mediamodecheck.toggled.connect(self.on_mediamodecheck)
         self.dualmodecheck.toggled.connect(self.on_dualmodecheck)
@@ -529,15 +826,22 @@ class DemiMoveGUI(QtGui.QMainWindow):
             self.committhread.start()
 
     def on_undobutton(self):
-        """Pops the history stack of commits, reverting the one on top."""
-        log.info("Reverting last commit.")
-        self.fileops.undo()
-        self.update(2)
+        """Revert the commit selected in the history tab or the last one."""
+        commitid = self.get_selected_commit()
+        if commitid is not None:
+            log.info("Reverting commit {}.".format(commitid))
+            self.fileops.undo_commit(commitid)
+        else:
+            log.info("Reverting last commit.")
+            self.fileops.undo()
+        self.refresh_changes()
+        self.create_historytab()
+        self.show_stats()
 
     def on_refreshbutton(self):
         """Force a refresh of browser view and model."""
         if self.updatethread.isRunning():
-            self.fileops.stopupdate = True
+            self.cancel_update()
         else:
             self.update(2)
 
@@ -578,9 +882,28 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.fileops.recursivedepth = int(num)
         self.update(2)
 
+    def on_workers(self, num):
+        self.fileops.workers = int(num)
+
     def on_autostopcheck(self, checked):
         self.fileops.autostop = checked
 
+    def on_cachecheck(self, checked):
+        self.fileops.cache = checked
+
+    def on_lazycheck(self, checked):
+        self.lazypreviews = checked
+        self.update()
+
+    def on_statscheck(self, checked):
+        self.fileops.stats.enabled = checked
+        self.statsresetbutton.setEnabled(checked)
+        self.show_stats()
+
+    def on_statsresetbutton(self):
+        self.fileops.stats.reset()
+        self.statsview.clear()
+
     def on_matchcheck(self, checked):
         self.fileops.matchcheck = checked
         if not checked:
@@ -689,6 +1012,10 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.fileops.countfill = checked
         self.update()
 
+    def on_countdircheck(self, checked):
+        self.fileops.countdirs = checked
+        self.update()
+
     def on_removecheck(self, checked):
         self.fileops.removecheck = checked
         self.update()
@@ -808,6 +1135,10 @@ class DemiMoveGUI(QtGui.QMainWindow):
         self.fileops.spacemode = index
         self.update()
 
+    def on_sortbox(self, index):
+        self.fileops.sortmode = index
+        self.update()
+
     @property
     def cwd(self):
         return self._cwd
@@ -3,7 +3,19 @@ import codecs
 import logging
 import os
 import re
+import stat
 import sys
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from unicodedata import normalize
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 log = logging.getLogger("helpers")
@@ -24,7 +36,7 @@ def configure_logger(loglevel=2, quiet=False, logdir=None):
     formatter = logging.Formatter(logformat, "%Y-%m-%d %H:%M:%S")
 
     if not quiet:
-        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler = logging.StreamHandler(sys.stderr)
         console_handler.setFormatter(formatter)
         logger.addHandler(console_handler)
         logger.debug("Added logging console handler.")
@@ -75,16 +87,197 @@ def translate(pat):
     return res
 
 
-def walklevels(path, levels=1):
-    """Wrap os.walk to allow setting recursion depth."""
-    path = path.rstrip(os.path.sep)
+def compile_patterns(text, regex=False, flags=0):
+    """Compile a slash separated list of glob/regex patterns into a regex.
+
+    The patterns are joined into a single alternation so matching a name
+    is one search call. Invalid regular expressions are skipped. Patterns
+    that use groups are compiled separately since joining them would shift
+    their backreferences, and so are those with inline flags like (?i),
+    which would apply to the whole alternation. Returns a list of compiled
+    patterns."""
+    patterns = text.split("/")
+    if not regex:
+        # Anchor like fnmatch.fnmatch does.
+        patterns = ["(?:{})\Z".format(translate(p)) for p in patterns]
+        try:
+            return [re.compile("^(?:{})".format("|".join(patterns)), re.S)]
+        except re.error:
+            log.debug("Invalid pattern: {}.".format(text))
+            return []
+
+    compiled, plain = [], []
+    baseflags = re.compile("", flags).flags
+    for pattern in patterns:
+        try:
+            rx = re.compile(pattern, flags)
+        except re.error:
+            log.debug("Invalid pattern: {}.".format(pattern))
+            continue
+        if rx.groups or rx.flags != baseflags:
+            compiled.append(rx)
+        else:
+            plain.append("(?:{})".format(pattern))
+    if plain:
+        compiled.insert(0, re.compile("|".join(plain), flags))
+    return compiled
+
+
+def listdir(path):
+    """List path and sort its entries into dirs and files.
+
+    Returns (dirs, files, walkdirs) where walkdirs are the dirs that can be
+    descended into. Like os.walk, symlinks to directories count as dirs but
+    are not followed. The entry type comes from the directory listing itself
+    if scandir is available, so no extra stat is needed per entry."""
+    dirs, files, walkdirs = [], [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                isdir = entry.is_dir()
+            except OSError:
+                isdir = False
+            if isdir:
+                dirs.append(entry.name)
+                if not entry.is_symlink():
+                    walkdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        return dirs, files, walkdirs
+
+    for name in os.listdir(path):
+        fullpath = os.path.join(path, name)
+        try:
+            mode = os.lstat(fullpath).st_mode
+        except OSError:
+            files.append(name)
+            continue
+        if stat.S_ISDIR(mode):
+            dirs.append(name)
+            walkdirs.append(name)
+        elif stat.S_ISLNK(mode) and os.path.isdir(fullpath):
+            dirs.append(name)
+        else:
+            files.append(name)
+    return dirs, files, walkdirs
+
+
+def walklevels(path, levels=1, lister=listdir):
+    """Walk path top-down like os.walk, down to a depth of levels.
+    lister is the function used to list each directory."""
+    path = path.rstrip(os.path.sep) or os.path.sep
     assert os.path.isdir(path)
-    num_sep = path.count(os.path.sep)
-    for root, dirs, files in os.walk(path):
+    stack = [(path, 0)]
+    while stack:
+        root, level = stack.pop()
+        try:
+            dirs, files, walkdirs = lister(root)
+        except OSError as e:
+            log.debug("Could not list {}: {}.".format(root, e))
+            continue
         yield root, dirs, files
-        num_sep_this = root.count(os.path.sep)
-        if num_sep + levels <= num_sep_this:
-            del dirs[:]
+        if level < levels:
+            # Reversed so that the stack pops them in listing order.
+            stack.extend((os.path.join(root, d), level + 1)
+                         for d in reversed(walkdirs))
+
+
+def walklevels_parallel(path, levels=1, workers=4, stop=None,
+                        lister=listdir):
+    """Walk path down to a depth of levels, listing the directories of each
+    level concurrently on a pool of threads.
+
+    Directories are yielded level by level, each level in listing order, so
+    the output order does not depend on which thread finishes first.
+    stop is an optional callable that cancels the walk when it returns
+    True."""
+    path = path.rstrip(os.path.sep) or os.path.sep
+    assert os.path.isdir(path)
+
+    def scan(root):
+        if stop is not None and stop():
+            return
+        try:
+            return lister(root)
+        except OSError as e:
+            log.debug("Could not list {}: {}.".format(root, e))
+
+    pool = ThreadPool(workers)
+    try:
+        level, roots = 0, [path]
+        while roots:
+            nextroots = []
+            # imap keeps the input order but hands out results as they come.
+            for root, listing in izip(roots, pool.imap(scan, roots)):
+                if stop is not None and stop():
+                    return
+                if listing is None:
+                    continue
+                dirs, files, walkdirs = listing
+                yield root, dirs, files
+                if level < levels:
+                    nextroots.extend(os.path.join(root, d) for d in walkdirs)
+            roots = nextroots
+            level += 1
+    finally:
+        pool.terminate()
+
+
+def apply_joined(names, func):
+    """Apply a string function to a whole list of names in one call.
+
+    The names are joined with null bytes, which can't be part of a file
+    name, so func must neither create nor remove them. Raises UnicodeError
+    for lists mixing unicode and non-ascii byte strings."""
+    if not names:
+        return []
+    return func("\0".join(names)).split("\0")
+
+
+class TransliterationTable(dict):
+    """Translation table for unicode.translate that reduces characters to
+    their allowed NFKD components, e.g. u"\xe9" to u"e".
+
+    Code points are looked up the first time they are seen. At most
+    maxsize of them are kept, the rest is recomputed on every lookup.
+    Null bytes are kept so that joined names can be translated at once."""
+
+    def __init__(self, allowed, maxsize=65536):
+        super(TransliterationTable, self).__init__({0: u"\0"})
+        self.allowed = frozenset(unicode(allowed))
+        self.maxsize = maxsize
+
+    def __missing__(self, codepoint):
+        allowed = self.allowed
+        value = u"".join(c for c in normalize("NFKD", unichr(codepoint))
+                         if c in allowed) or None
+        if len(self) < self.maxsize:
+            self[codepoint] = value
+        return value
+
+
+def iter_records(stream, sep="\0", size=65536):
+    """Yield the sep separated records of a file object as they are read,
+    without the separator. Empty records are skipped."""
+    # file.read blocks until size bytes arrived, os.read returns whatever
+    # a pipe has ready so slow producers are still streamed.
+    try:
+        fd = stream.fileno()
+        read = lambda: os.read(fd, size)
+    except (AttributeError, IOError):
+        read = lambda: stream.read(size)
+    rest = ""
+    while True:
+        chunk = read()
+        if not chunk:
+            break
+        records = (rest + chunk).split(sep)
+        rest = records.pop()
+        for record in records:
+            if record:
+                yield record
+    if rest:
+        yield rest
 
 
 splitrx = re.compile("(^(?:\w\:)?\/.*\/)(.*?)(\..*)?$")
@@ -131,7 +324,7 @@ def load_configfile(configdir, configfile=None):
                                  "filteredit": "",
                                  "excludeedit": "",
                                  "matchedit": ""},
-                      "combos": {"casebox": 0, "spacebox": 0},
+                      "combos": {"casebox": 0, "spacebox": 0, "sortbox": 0},
                       "checks": {"countcheck": False,
                                  "switchviewcheck": False,
                                  "keepextensionscheck": True,
@@ -154,7 +347,11 @@ def load_configfile(configdir, configfile=None):
                                  "matchcheck": True,
                                  "removenonwordscheck": False,
                                  "removecheck": False,
-                                 "countfillcheck": True},
+                                 "countfillcheck": True,
+                                 "cachecheck": False,
+                                 "statscheck": False,
+                                 "lazycheck": False,
+                                 "countdircheck": False},
                       "radios": {"dirsradio": False,
                                  "globradio": True,
                                  "filesradio": False,
@@ -166,7 +363,8 @@ def load_configfile(configdir, configfile=None):
                                  "countstep": 1,
                                  "deletestart": 0,
                                  "insertpos": 0,
-                                 "recursivedepth": 0}
+                                 "recursivedepth": 0,
+                                 "workers": 1}
                         }
     options = {}
     try:
@@ -1,11 +1,16 @@
+import time
+
 from PyQt4 import QtCore
 
 
 class TreeItem(object):
-    def __init__(self, data, parent=None):
+    def __init__(self, data, parent=None, row=0, total=0, commitid=None):
         self.parentItem = parent
         self.itemData = data
         self.childItems = []
+        self.row = row  # Position in parentItem.childItems.
+        self.total = total  # Number of children, fetched or not.
+        self.commitid = commitid
 
     def child(self, row):
         return self.childItems[row]
@@ -14,9 +19,7 @@ class TreeItem(object):
         return len(self.childItems)
 
     def childNumber(self):
-        if self.parentItem != None:
-            return self.parentItem.childItems.index(self)
-        return 0
+        return self.row
 
     def columnCount(self):
         return len(self.itemData)
@@ -24,73 +27,33 @@ class TreeItem(object):
     def data(self, column):
         return self.itemData[column]
 
-    def insertChildren(self, position, count, columns):
-        if position < 0 or position > len(self.childItems):
-            return False
-
-        for row in range(count):
-            data = [None for _ in range(columns)]
-            item = TreeItem(data, self)
-            self.childItems.insert(position, item)
-
-        return True
-
-    def insertColumns(self, position, columns):
-        if position < 0 or position > len(self.itemData):
-            return False
-
-        for column in range(columns):
-            self.itemData.insert(position, None)
-
-        for child in self.childItems:
-            child.insertColumns(position, columns)
-
-        return True
+    def appendChildren(self, items):
+        for data, total, commitid in items:
+            self.childItems.append(TreeItem(data, self, len(self.childItems),
+                                            total, commitid))
 
     def parent(self):
         return self.parentItem
 
-    def removeChildren(self, position, count):
-        if position < 0 or position + count > len(self.childItems):
-            return False
-
-        for row in range(count):
-            self.childItems.pop(position)
-
-        return True
-
-    def removeColumns(self, position, columns):
-        if position < 0 or position + columns > len(self.itemData):
-            return False
-
-        for column in range(columns):
-            self.itemData.pop(position)
-
-        for child in self.childItems:
-            child.removeColumns(position, columns)
-
-        return True
-
-    def setData(self, column, value):
-        if column < 0 or column >= len(self.itemData):
-            return False
-
-        self.itemData[column] = value
-
-        return True
-
 
 class HistoryTreeModel(QtCore.QAbstractItemModel):
+    """Read-only tree of commits and their renames in a HistoryStore.
+
+    Nothing is loaded up front. Views ask for more rows through
+    canFetchMore/fetchMore as they scroll, which loads commits and the
+    renames of expanded commits one page at a time."""
 
-    def __init__(self, data, parent=None):
+    def __init__(self, store, parent=None, pagesize=256):
         super(HistoryTreeModel, self).__init__(parent)
         self.p = parent
+        self.store = store
+        self.pagesize = pagesize
 
         headers = ("Original", "Current")
 
         rootData = [header for header in headers]
-        self.rootItem = TreeItem(rootData)
-        self.setupModelData(data.split("\n"), self.rootItem)
+        total = store.count() if store is not None else 0
+        self.rootItem = TreeItem(rootData, total=total)
 
     def columnCount(self, parent=QtCore.QModelIndex()):
         return self.rootItem.columnCount()
@@ -99,7 +62,7 @@ class HistoryTreeModel(QtCore.QAbstractItemModel):
         if not index.isValid():
             return None
 
-        if role != QtCore.Qt.DisplayRole and role != QtCore.Qt.EditRole:
+        if role != QtCore.Qt.DisplayRole:
             return None
 
         item = self.getItem(index)
@@ -109,7 +72,7 @@ class HistoryTreeModel(QtCore.QAbstractItemModel):
         if not index.isValid():
             return 0
 
-        return QtCore.Qt.ItemIsEditable | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
 
     def getItem(self, index):
         if index.isValid():
@@ -130,28 +93,11 @@ class HistoryTreeModel(QtCore.QAbstractItemModel):
             return QtCore.QModelIndex()
 
         parentItem = self.getItem(parent)
-        childItem = parentItem.child(row)
-        if childItem:
-            return self.createIndex(row, column, childItem)
+        if 0 <= row < parentItem.childCount():
+            return self.createIndex(row, column, parentItem.child(row))
         else:
             return QtCore.QModelIndex()
 
-    def insertColumns(self, position, columns, parent=QtCore.QModelIndex()):
-        self.beginInsertColumns(parent, position, position + columns - 1)
-        success = self.rootItem.insertColumns(position, columns)
-        self.endInsertColumns()
-
-        return success
-
-    def insertRows(self, position, rows, parent=QtCore.QModelIndex()):
-        parentItem = self.getItem(parent)
-        self.beginInsertRows(parent, position, position + rows - 1)
-        success = parentItem.insertChildren(position, rows,
-                self.rootItem.columnCount())
-        self.endInsertRows()
-
-        return success
-
     def parent(self, index):
         if not index.isValid():
             return QtCore.QModelIndex()
@@ -159,94 +105,65 @@ class HistoryTreeModel(QtCore.QAbstractItemModel):
         childItem = self.getItem(index)
         parentItem = childItem.parent()
 
-        if parentItem == self.rootItem:
+        if parentItem is None or parentItem == self.rootItem:
             return QtCore.QModelIndex()
 
         return self.createIndex(parentItem.childNumber(), 0, parentItem)
 
-    def removeColumns(self, position, columns, parent=QtCore.QModelIndex()):
-        self.beginRemoveColumns(parent, position, position + columns - 1)
-        success = self.rootItem.removeColumns(position, columns)
-        self.endRemoveColumns()
-
-        if self.rootItem.columnCount() == 0:
-            self.removeRows(0, self.rowCount())
-
-        return success
-
-    def removeRows(self, position, rows, parent=QtCore.QModelIndex()):
-        parentItem = self.getItem(parent)
-
-        self.beginRemoveRows(parent, position, position + rows - 1)
-        success = parentItem.removeChildren(position, rows)
-        self.endRemoveRows()
-
-        return success
-
     def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
         parentItem = self.getItem(parent)
 
         return parentItem.childCount()
 
-    def setData(self, index, value, role=QtCore.Qt.EditRole):
-        if role != QtCore.Qt.EditRole:
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
             return False
+        return self.getItem(parent).total > 0
+
+    def canFetchMore(self, parent):
+        item = self.getItem(parent)
+        return item.childCount() < item.total
+
+    def fetchMore(self, parent):
+        item = self.getItem(parent)
+        start = item.childCount()
+        if item == self.rootItem:
+            rows = self.get_commits(start)
+        elif item.commitid is not None:
+            rows = self.get_renames(item.commitid, start)
+        else:
+            return
+        if not rows:
+            # The store shrank or was never filled, stop asking.
+            item.total = start
+            return
+
+        self.beginInsertRows(parent, start, start + len(rows) - 1)
+        item.appendChildren(rows)
+        self.endInsertRows()
 
+    def get_commits(self, start):
+        rows = []
+        for commitid, timestamp, count, undone in self.store.get_commits(
+                start, self.pagesize):
+            date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+            status = "{} renames{}".format(count, " (undone)" if undone else "")
+            rows.append((["#{} {}".format(commitid, date), status], count,
+                         commitid))
+        return rows
+
+    def get_renames(self, commitid, start):
+        renames = self.store.get_renames(commitid, start, self.pagesize)
+        return [([src.decode("utf-8", "replace"),
+                  dst.decode("utf-8", "replace")], 0, None)
+                for src, dst in renames]
+
+    def get_commitid(self, index):
+        """Return the id of the commit index belongs to, None for none."""
         item = self.getItem(index)
-        result = item.setData(index.column(), value)
-
-        if result:
-            self.dataChanged.emit(index, index)
-
-        return result
-
-    def setHeaderData(self, section, orientation, value, role=QtCore.Qt.EditRole):
-        if role != QtCore.Qt.EditRole or orientation != QtCore.Qt.Horizontal:
-            return False
-
-        result = self.rootItem.setData(section, value)
-        if result:
-            self.headerDataChanged.emit(orientation, section, section)
-
-        return result
-
-    def setupModelData(self, lines, parent):
-        parents = [parent]
-        indentations = [0]
-
-        number = 0
-
-        while number < len(lines):
-            position = 0
-            while position < len(lines[number]):
-                if lines[number][position] != " ":
-                    break
-                position += 1
-
-            lineData = lines[number][position:].strip()
-
-            if lineData:
-                # Read the column data from the rest of the line.
-                columnData = [s for s in lineData.split('\t') if s]
-
-                if position > indentations[-1]:
-                    # The last child of the current parent is now the new
-                    # parent unless the current parent has no children.
-
-                    if parents[-1].childCount() > 0:
-                        parents.append(parents[-1].child(parents[-1].childCount() - 1))
-                        indentations.append(position)
-
-                else:
-                    while position < indentations[-1] and len(parents) > 0:
-                        parents.pop()
-                        indentations.pop()
-
-                # Append a new item to the current parent's list of children.
-                parent = parents[-1]
-                parent.insertChildren(parent.childCount(), 1,
-                        self.rootItem.columnCount())
-                for column in range(len(columnData)):
-                    parent.child(parent.childCount() - 1).setData(column, columnData[column])
-
-            number += 1
+        while item is not None:
+            if item.commitid is not None:
+                return item.commitid
+            item = item.parentItem
@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import time
+
+
+log = logging.getLogger("historystore")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    count INTEGER NOT NULL,
+    undone INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS renames (
+    commitid INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    PRIMARY KEY (commitid, seq)
+);
+CREATE INDEX IF NOT EXISTS commits_timestamp ON commits (timestamp);
+CREATE INDEX IF NOT EXISTS renames_src ON renames (src, commitid);
+CREATE INDEX IF NOT EXISTS renames_dst ON renames (dst, commitid);
+"""
+
+
+def encode(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+class HistoryStore(object):
+    """Commits and their renames, persisted in an SQLite database.
+
+    Every commit gets an increasing id. Its renames are stored in the
+    order they were carried out and indexed by commit, source and
+    destination, so paging through the history, finding the commit that
+    last touched a path and checking whether a commit can still be undone
+    don't depend on the size of the history."""
+
+    def __init__(self, configdir):
+        self.dbfile = os.path.join(configdir, "history.db")
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        # Paths are byte strings that need not be valid UTF-8.
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, actions, timestamp=None, commitid=None):
+        """Store a commit of (src, dst) renames and return its id. If
+        commitid is given, the renames are appended to that commit."""
+        if timestamp is None:
+            timestamp = time.time()
+        with self.db:
+            if commitid is None:
+                cursor = self.db.execute("INSERT INTO commits (timestamp, "
+                                         "count) VALUES (?, ?)",
+                                         (timestamp, len(actions)))
+                commitid, start = cursor.lastrowid, 0
+            else:
+                start = self.db.execute("SELECT count FROM commits WHERE "
+                                        "id = ?", (commitid,)).fetchone()[0]
+                self.db.execute("UPDATE commits SET count = count + ? WHERE "
+                                "id = ?", (len(actions), commitid))
+            self.db.executemany("INSERT INTO renames VALUES (?, ?, ?, ?)",
+                                ((commitid, seq, encode(src), encode(dst))
+                                 for seq, (src, dst) in enumerate(actions,
+                                                                  start)))
+        log.debug("Stored commit {} ({} renames).".format(commitid,
+                                                          len(actions)))
+        return commitid
+
+    def count(self):
+        return self.db.execute("SELECT count(*) FROM commits").fetchone()[0]
+
+    def last(self):
+        """Return the id of the newest commit that wasn't undone."""
+        row = self.db.execute("SELECT max(id) FROM commits "
+                              "WHERE undone = 0").fetchone()
+        return row[0]
+
+    def get_commit(self, commitid):
+        """Return (id, timestamp, count, undone) of a commit or None."""
+        return self.db.execute("SELECT id, timestamp, count, undone "
+                               "FROM commits WHERE id = ?",
+                               (commitid,)).fetchone()
+
+    def get_commits(self, offset=0, limit=100):
+        """Return a page of (id, timestamp, count, undone), newest first."""
+        return self.db.execute("SELECT id, timestamp, count, undone "
+                               "FROM commits ORDER BY id DESC "
+                               "LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+
+    def get_renames(self, commitid, offset=0, limit=-1):
+        """Return a page of the (src, dst) renames of a commit."""
+        return self.db.execute("SELECT src, dst FROM renames "
+                               "WHERE commitid = ? AND seq >= ? "
+                               "ORDER BY seq LIMIT ?",
+                               (commitid, offset, limit)).fetchall()
+
+    def last_commit_for(self, path):
+        """Return the id of the newest commit that renamed path or renamed
+        something to path, None if there is none."""
+        path = encode(path)
+        found = [self.db.execute("SELECT max(commitid) FROM renames "
+                                 "WHERE {} = ?".format(column),
+                                 (path,)).fetchone()[0]
+                 for column in ("src", "dst")]
+        return max(found) if any(i is not None for i in found) else None
+
+    def get_moved_since(self, commitid):
+        """Return destinations of commitid that a later commit, which wasn't
+        undone, renamed again."""
+        return [i[0] for i in self.db.execute(
+            "SELECT DISTINCT r.dst FROM renames r "
+            "JOIN renames l ON l.src = r.dst AND l.commitid > r.commitid "
+            "JOIN commits c ON c.id = l.commitid AND c.undone = 0 "
+            "WHERE r.commitid = ?", (commitid,))]
+
+    def set_undone(self, commitid, undone=True):
+        with self.db:
+            self.db.execute("UPDATE commits SET undone = ? WHERE id = ?",
+                            (int(undone), commitid))
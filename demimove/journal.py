@@ -0,0 +1,223 @@
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where journals aren't locked.
+    fcntl = None
+
+
+log = logging.getLogger("journal")
+
+
+def encode(path):
+    if isinstance(path, unicode):
+        return path.encode("utf-8")
+    return path
+
+
+class Journal(object):
+    """Write-ahead log of the commit that is currently running.
+
+    The whole rename plan is written and synced to disk before the first
+    rename happens, then every completed rename is appended. The file is
+    removed once the commit is finished, so a journal found on startup
+    belongs to a commit that was interrupted.
+
+    Records are null separated so that any path can be stored:
+    "plan", pid, count, src, dst, ... then "done", src, dst per rename.
+    A commit that is carried out in parts, like a stream of batches, adds
+    a "plan" record per part before renaming it. Each record is flushed
+    right away so it survives a crash of the process, but only synced to
+    disk every syncinterval records. Renames lost from the journal by a
+    crash of the system are found by looking at the filesystem when the
+    journal is recovered.
+
+    The process that writes, recovers or removes the journal holds an
+    exclusive lock on it, so that another demimove instance neither takes
+    a running commit for an interrupted one nor overwrites its journal."""
+
+    def __init__(self, configdir):
+        self.journalfile = os.path.join(configdir, "commit.journal")
+        self.syncinterval = 512  # Completed renames between fsyncs.
+        self.lock = threading.Lock()
+        self.f = None
+        self.unsynced = 0
+
+    def exists(self):
+        return os.path.exists(self.journalfile)
+
+    @property
+    def active(self):
+        "Whether a commit is being journaled."
+        return self.f is not None
+
+    def locked(self):
+        """Whether another process holds the journal, i.e. runs a commit."""
+        if fcntl is None or self.f is not None:
+            return False
+        try:
+            f = open(self.journalfile, "rb")
+        except IOError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                return True
+        return False
+
+    def acquire(self):
+        """Open and lock the journal, creating it if needed. Returns False
+        if another process holds it."""
+        while True:
+            f = open(self.journalfile, "ab")
+            if fcntl is None:
+                break
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                f.close()
+                return False
+            # The holder might have removed the file before letting go.
+            try:
+                if os.path.samestat(os.fstat(f.fileno()),
+                                    os.stat(self.journalfile)):
+                    break
+            except OSError:
+                pass
+            f.close()
+        self.f = f
+        return True
+
+    def release(self):
+        """Unlock and close the journal, leaving it in place."""
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.close()
+            self.f = None
+
+    def begin(self, actions):
+        """Record the plan of a commit and sync it before returning.
+        Returns False if another process holds the journal."""
+        if not self.acquire():
+            log.error("Another commit is running.")
+            return False
+        self.f.truncate(0)
+        self.add(actions)
+        return True
+
+    def add(self, actions):
+        """Record the plan of more renames of the running commit and sync
+        it before returning."""
+        with self.lock:
+            self.f.write("plan\0{}\0{}\0".format(os.getpid(), len(actions)))
+            for src, dst in actions:
+                self.f.write("{}\0{}\0".format(encode(src), encode(dst)))
+            self.sync()
+        log.debug("Journaled {} renames.".format(len(actions)))
+
+    def record(self, src, dst):
+        """Append a completed rename. Safe to call from worker threads."""
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write("done\0{}\0{}\0".format(encode(src), encode(dst)))
+            self.unsynced += 1
+            if self.unsynced >= self.syncinterval:
+                self.sync()
+            else:
+                self.f.flush()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsynced = 0
+
+    def finish(self):
+        """Close and remove the journal of a commit that ran to its end."""
+        with self.lock:
+            if self.f is None:
+                return
+            # Removed while still locked, so no one can take it over.
+            self.discard()
+            self.f.close()
+            self.f = None
+
+    def discard(self):
+        try:
+            os.remove(self.journalfile)
+        except OSError as e:
+            if os.path.exists(self.journalfile):
+                log.error("Could not remove journal: {}.".format(e))
+
+    def load(self, exists=os.path.lexists):
+        """Return (plan, done) for an interrupted commit or None.
+
+        done lists the renames of plan that were carried out, in plan order.
+        A rename missing from the journal counts as done if its source is
+        gone and its destination exists. That can't be told for swaps and
+        chains, where names are reused, so those have to be journaled."""
+        if not self.exists():
+            return
+        if not self.acquire():
+            log.info("The journal belongs to a commit that is running.")
+            return
+        try:
+            return self.recover(exists)
+        finally:
+            self.release()
+
+    def recover(self, exists):
+        try:
+            with open(self.journalfile, "rb") as f:
+                fields = f.read().split("\0")
+        except IOError:
+            return
+        # The last field is empty or a record cut short by the crash.
+        fields.pop()
+        if not fields or fields[0] != "plan":
+            log.error("Discarding unreadable journal.")
+            self.discard()
+            return
+        plan, recorded, i = [], set(), 0
+        while i < len(fields):
+            if fields[i] == "plan":
+                try:
+                    count = int(fields[i + 2])
+                except (IndexError, ValueError):
+                    break
+                planned = fields[i + 3:i + 3 + 2 * count]
+                if len(planned) < 2 * count:
+                    # Never synced, so nothing of it was renamed yet.
+                    break
+                plan.extend(zip(planned[::2], planned[1::2]))
+                i += 3 + 2 * count
+            elif fields[i] == "done" and i + 2 < len(fields):
+                recorded.add((fields[i + 1], fields[i + 2]))
+                i += 3
+            else:
+                break
+        if not plan:
+            log.info("Discarding journal of a commit that never started.")
+            self.discard()
+            return
+
+        srcs = set(i[0] for i in plan)
+        dsts = set(i[1] for i in plan)
+        done = []
+        for src, dst in plan:
+            if (src, dst) in recorded:
+                done.append((src, dst))
+            elif src in dsts or dst in srcs:
+                continue
+            elif not exists(src) and exists(dst):
+                done.append((src, dst))
+        log.info("Found interrupted commit from {}: {} of {} renames done."
+                 .format(time.ctime(os.path.getmtime(self.journalfile)),
+                         len(done), len(plan)))
+        return plan, done
@@ -0,0 +1,165 @@
+from cStringIO import StringIO
+import cPickle as pickle
+import logging
+import os
+import time
+
+import helpers
+
+
+log = logging.getLogger("listcache")
+
+
+class ListingCache(object):
+    """Directory listings persisted across sessions.
+
+    Each listing is stored with the mtime its directory had when it was
+    listed. Adding, removing or renaming an entry changes the mtime of the
+    directory, so unchanged directories can be served from the cache and
+    only modified ones have to be listed again.
+
+    The cache file is a log of (path, (mtime, listing)) records, or
+    (path, None) for a dropped listing, and a save only appends the records
+    of listings that changed since the last one. Once most records in the
+    file are outdated, it is written anew. Listings of directories that
+    were removed or renamed are dropped along with everything below them
+    when their parent is listed again or they can't be found anymore, and
+    any that are left when the file is written anew."""
+
+    def __init__(self, configdir):
+        self.cachefile = os.path.join(configdir, "listings.cache")
+        self.listings = {}
+        self.changed = {}  # path -> record not yet written to the cache file
+        self.removed = set()  # Dirs whose listings below have to be dropped.
+        self.records = 0  # Records in the cache file.
+        # Don't trust listings of directories modified within this many
+        # seconds, the filesystem's mtime resolution might hide changes.
+        self.graceperiod = 2
+        # Rewrite the cache file once it holds this many times as many
+        # records as there are listings.
+        self.compactratio = 2
+        self.load()
+
+    @property
+    def dirty(self):
+        return bool(self.changed or self.removed)
+
+    def load(self):
+        self.listings, self.records = {}, 0
+        try:
+            with open(self.cachefile, "rb") as f:
+                data = f.read()
+        except IOError:
+            return
+        stream = StringIO(data)
+        unpickler = pickle.Unpickler(stream)
+        while stream.tell() < len(data):
+            try:
+                path, entry = unpickler.load()
+            except Exception as e:
+                # Most likely the tail of a save that was cut short. Keep
+                # what could be read and write the file anew on next save.
+                log.error("Could not load listing cache: {}.".format(e))
+                self.records = float("inf")
+                break
+            if entry is None:
+                self.listings.pop(path, None)
+            else:
+                self.listings[path] = entry
+            self.records += 1
+        log.debug("Loaded {} cached listings.".format(len(self.listings)))
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.prune()
+        if self.records + len(self.changed) > max(
+                self.compactratio * len(self.listings), 1024):
+            self.rewrite()
+        else:
+            self.append()
+
+    def append(self):
+        """Append the records of the listings changed since the last save."""
+        try:
+            with open(self.cachefile, "ab") as f:
+                pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                for record in self.changed.iteritems():
+                    pickler.dump(record)
+                    # Don't let the pickler remember objects across records.
+                    pickler.clear_memo()
+        except (IOError, OSError) as e:
+            log.error("Could not save listing cache: {}.".format(e))
+            # The file might end in a partial record now.
+            self.records = float("inf")
+        else:
+            log.debug("Saved {} changed listings.".format(len(self.changed)))
+            self.records += len(self.changed)
+            self.changed = {}
+
+    def rewrite(self):
+        """Write all listings to a new cache file, leaving out those of
+        directories that don't exist anymore."""
+        for path in self.listings.keys():
+            if not os.path.isdir(path):
+                self.drop(path)
+        # Write to a temporary file first so a crash can't corrupt the cache.
+        tmpfile = self.cachefile + ".tmp"
+        try:
+            with open(tmpfile, "wb") as f:
+                pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+                for record in self.listings.iteritems():
+                    pickler.dump(record)
+                    pickler.clear_memo()
+            os.rename(tmpfile, self.cachefile)
+        except (IOError, OSError) as e:
+            log.error("Could not save listing cache: {}.".format(e))
+        else:
+            self.records, self.changed = len(self.listings), {}
+            log.debug("Saved {} cached listings.".format(len(self.listings)))
+
+    def prune(self):
+        """Drop the listings of removed directories and of everything
+        below them."""
+        if not self.removed:
+            return
+        removed, self.removed = self.removed, set()
+        for path in self.listings.keys():
+            parent = path
+            while parent not in removed:
+                parent, name = os.path.split(parent)
+                if not name:
+                    break
+            else:
+                self.drop(path)
+
+    def drop(self, path):
+        if self.listings.pop(path, None) is not None:
+            self.changed[path] = None
+
+    def clear(self):
+        for path in self.listings.keys():
+            self.drop(path)
+
+    def listdir(self, path):
+        """Drop-in replacement for helpers.listdir that uses the cache."""
+        cached = self.listings.get(path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            if cached is not None:
+                self.removed.add(path)
+            raise
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        listing = helpers.listdir(path)
+        if cached is not None:
+            # Subdirectories that are gone or were renamed.
+            for name in set(cached[1][2]).difference(listing[2]):
+                self.removed.add(os.path.join(path, name))
+        if time.time() - mtime > self.graceperiod:
+            self.listings[path] = self.changed[path] = (mtime, listing)
+        else:
+            self.drop(path)
+        return listing
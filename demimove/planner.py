@@ -0,0 +1,123 @@
+import itertools
+import logging
+import os
+
+
+log = logging.getLogger("planner")
+
+
+def plan(actions, exists=os.path.lexists):
+    """Order a list of (source, destination) renames so that they can be
+    executed one after another without overwriting anything.
+
+    Returns (plan, collisions). plan is the ordered list of renames, where
+    swaps and other cycles are broken up through temporary names in the
+    same directory. Deeper paths come first so that the contents of a
+    directory are renamed before the directory itself. collisions lists
+    (source, destination, reason) for every rename that had to be skipped
+    because it would overwrite an existing file or another target."""
+    collisions = []
+    bysrc, bydst = {}, {}
+    for src, dst in actions:
+        if src == dst:
+            continue
+        if dst in bydst:
+            collisions.append((src, dst, "duplicate destination"))
+            continue
+        if src in bysrc:
+            collisions.append((src, dst, "duplicate source"))
+            continue
+        bysrc[src] = dst
+        bydst[dst] = src
+
+    # A destination that exists must be vacated by another rename first.
+    # Case-only renames on case-insensitive filesystems point to the file
+    # itself and are fine.
+    blocked = []
+    for src, dst in bysrc.iteritems():
+        if dst not in bysrc and exists(dst) and not samefile(src, dst):
+            blocked.append((src, "destination exists"))
+    # If a rename is skipped, its source stays occupied, so the rename that
+    # was waiting for it has to be skipped, too.
+    while blocked:
+        src, reason = blocked.pop()
+        dst = bysrc.pop(src, None)
+        if dst is None:
+            continue
+        del bydst[dst]
+        collisions.append((src, dst, reason))
+        waiting = bydst.get(src)
+        if waiting is not None:
+            blocked.append((waiting, "source of a skipped rename"))
+
+    # Bucket by depth instead of sorting to keep this linear.
+    depths = {}
+    for src in bysrc:
+        depths.setdefault(src.count("/"), []).append(src)
+
+    ordered, done, counter = [], set(), itertools.count()
+    for depth in sorted(depths, reverse=True):
+        for start in depths[depth]:
+            if start in done:
+                continue
+            # Follow the chain of renames whose destination is still taken
+            # by the source of another pending rename.
+            chain, src = [], start
+            while src is not None and src not in done:
+                chain.append(src)
+                done.add(src)
+                src = bysrc[src]
+                if src not in bysrc:
+                    src = None
+            if src is None or src != start:
+                # A plain chain: vacate the end of it first.
+                ordered.extend((s, bysrc[s]) for s in reversed(chain))
+                continue
+            # A cycle: park the first source under a temporary name, rename
+            # the rest of the cycle backwards and move the parked one last.
+            temp = get_tempname(start, counter, bydst, exists)
+            ordered.append((start, temp))
+            ordered.extend((s, bysrc[s]) for s in reversed(chain[1:]))
+            ordered.append((temp, bysrc[start]))
+
+    return ordered, collisions
+
+
+def get_parked(plan):
+    """Return {temporary name: source} of the sources plan parks to break
+    up cycles. A destination that is the source of a later rename can only
+    be a temporary name, as nothing else is renamed again."""
+    later, parked = set(), {}
+    for src, dst in reversed(plan):
+        if dst in later:
+            parked[dst] = src
+        later.add(src)
+    return parked
+
+
+def unpark(renames, parked):
+    """Return renames, tuples that start with source and destination, with
+    the steps of every parked source merged into the rename they were
+    planned for, e.g. to report them. The step that parks a source is left
+    out and the one that moves it on stands for the whole rename."""
+    if not parked:
+        return renames
+    return [(parked.get(r[0], r[0]),) + tuple(r[1:]) for r in renames
+            if r[1] not in parked]
+
+
+def samefile(src, dst):
+    try:
+        return os.path.samefile(src, dst)
+    except OSError:
+        return False
+
+
+def get_tempname(path, counter, taken, exists):
+    """Return an unused temporary name in the directory of path."""
+    root = os.path.dirname(path)
+    while True:
+        name = os.path.join(root, ".demimove-{}-{}".format(os.getpid(),
+                                                           next(counter)))
+        if name not in taken and not exists(name):
+            return name
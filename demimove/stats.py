@@ -0,0 +1,90 @@
+import time
+
+
+class NullTimer(object):
+    "Timer that does nothing, handed out while stats are disabled."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class Timer(object):
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.stats.add_time(self.name, time.time() - self.start)
+
+
+class Stats(object):
+    """Counters and timers of the operations FileOps runs.
+
+    Instrumented code checks enabled before counting anything, and timer()
+    returns a shared no-op context manager while disabled, so leaving stats
+    off costs one attribute lookup per directory or stage. Values add up
+    until reset() is called."""
+
+    nulltimer = NullTimer()
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.timers = {}  # name -> [total seconds, calls]
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [seconds, 1]
+        else:
+            timer[0] += seconds
+            timer[1] += 1
+
+    def timer(self, name):
+        """Return a context manager that adds its runtime to timer name."""
+        if not self.enabled:
+            return self.nulltimer
+        return Timer(self, name)
+
+    def get_stats(self):
+        """Return a snapshot as {"counters": {..}, "timers": {name:
+        {"seconds": s, "calls": n}}} plus rates derived from them."""
+        counters = dict(self.counters)
+        timers = dict((k, {"seconds": v[0], "calls": v[1]})
+                      for k, v in self.timers.items())
+        rates = {}
+        commit = self.timers.get("commit")
+        if commit is not None and commit[0] > 0:
+            rates["renames/s"] = counters.get("renames", 0) / commit[0]
+        scan = self.timers.get("scan")
+        if scan is not None and scan[0] > 0:
+            rates["dirs/s"] = counters.get("dirs walked", 0) / scan[0]
+        return {"counters": counters, "timers": timers, "rates": rates}
+
+    def format(self):
+        """Return the stats as human readable lines."""
+        stats = self.get_stats()
+        lines = []
+        for name, value in sorted(stats["counters"].items()):
+            lines.append("{:<24} {:>12}".format(name, value))
+        for name, timer in sorted(stats["timers"].items()):
+            lines.append("{:<24} {:>11.3f}s {:>6} calls".format(
+                         name, timer["seconds"], timer["calls"]))
+        for name, value in sorted(stats["rates"].items()):
+            lines.append("{:<24} {:>12.0f}".format(name, value))
+        return lines
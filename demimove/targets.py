@@ -0,0 +1,447 @@
+from array import array
+from itertools import chain, compress, imap, islice, izip, repeat
+import bisect
+import collections
+import operator
+import os
+import re
+
+
+digitsrx = re.compile(r"\d+")
+
+
+def natural_keys(filenames):
+    """Return sort keys that order numbers in filenames by value and
+    ignore case, so that "ep2" sorts before "Ep10".
+
+    Every run of digits is replaced by its length (as one character) and
+    the digits without leading zeros, so that plain string comparison
+    orders shorter numbers first. All names are processed in one string,
+    which keeps the work per name out of Python."""
+    if not filenames:
+        return []
+    joined = "\0".join(filenames).lower()
+    runs = digitsrx.findall(joined)
+    texts = digitsrx.split(joined)
+    encoded = {}
+    for run in set(runs):
+        digits = run.lstrip("0") or "0"
+        encoded[run] = chr(min(len(digits), 255)) + digits
+    keys = chain.from_iterable(izip(texts, map(encoded.__getitem__, runs)))
+    return ("".join(keys) + texts[-1]).split("\0")
+
+
+# Sort modes: 0 = by name, 1 = natural. None sorts by the file names.
+SORTKEYS = [None, natural_keys]
+
+
+class TargetTable(object):
+    """Compact, append-only list of targets.
+
+    Every directory root is stored once and referenced by index, file names
+    are kept whole with the position of their extension in an array. That
+    avoids a tuple and a root reference per target and the concatenated
+    names the transforms and previews would otherwise create.
+
+    Iterating yields the (root, name, ext) tuples targets used to be, for
+    everything else use the accessors. The first find() indexes the table
+    by path, appends keep the index up to date from then on. Sort keys, the
+    sorted order and the ranks used for counting are computed on first use
+    as well. Appends extend the keys, and the sorted order is merged with
+    the new rows the next time it is needed instead of being sorted again.
+    Ranks are recomputed from it."""
+
+    def __init__(self):
+        self.roots = []  # Distinct roots, each ending with a slash.
+        self.rootids = {}  # root -> index in roots
+        self.rootidx = array("l")  # Per target: index of its root.
+        self.filenames = []  # Per target: name + ext.
+        self.extpos = array("l")  # Per target: where ext starts in filename.
+        self.isdir = array("b")  # Per target: 1 for directories.
+        self.lookup = None  # rootid -> {filename: row}, see build_index.
+        self.sortkeys = {}  # sort mode -> per target: its sort key
+        # sort mode -> (rows in sorted order, their keys) of the first rows.
+        self.orders = {}
+        # (sort mode, per directory) -> see get_ranks, valid while it
+        # covers all rows.
+        self.ranks = {}
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __iter__(self):
+        roots = self.roots
+        for rootid, f, pos in izip(self.rootidx, self.filenames, self.extpos):
+            yield roots[rootid], f[:pos], f[pos:]
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return self.select(xrange(*row.indices(len(self))))
+        f, pos = self.filenames[row], self.extpos[row]
+        return self.roots[self.rootidx[row]], f[:pos], f[pos:]
+
+    def __repr__(self):
+        return "<TargetTable: {} targets in {} roots>".format(len(self),
+                                                              len(self.roots))
+
+    def get_rootid(self, root):
+        try:
+            return self.rootids[root]
+        except KeyError:
+            rootid = self.rootids[root] = len(self.roots)
+            self.roots.append(root)
+            if self.lookup is not None:
+                self.lookup[rootid] = {}
+            return rootid
+
+    def append(self, root, name, ext="", isdir=False):
+        self.extend_sortkeys([name + ext])
+        rootid = self.get_rootid(root)
+        self.rootidx.append(rootid)
+        self.filenames.append(name + ext)
+        self.isdir.append(isdir)
+        self.extpos.append(len(name))
+        if self.lookup is not None:
+            self.lookup[rootid][name + ext] = len(self.filenames) - 1
+
+    def add_dirs(self, root, dirs):
+        """Append directory names, which never have an extension."""
+        self.add(root, dirs, [len(d) for d in dirs], True)
+
+    def add_files(self, root, files):
+        self.add(root, files, [len(os.path.splitext(f)[0]) for f in files])
+
+    def add(self, root, filenames, extpos, isdir=False):
+        if not filenames:
+            return
+        self.extend_sortkeys(filenames)
+        rootid = self.get_rootid(root)
+        start = len(self.filenames)
+        self.rootidx.extend(array("l", [rootid]) * len(filenames))
+        self.filenames.extend(filenames)
+        self.isdir.extend(array("b", [isdir]) * len(filenames))
+        self.extpos.extend(extpos)
+        if self.lookup is not None:
+            self.lookup[rootid].update(izip(filenames, xrange(start,
+                                                              len(self))))
+
+    def extend(self, other):
+        """Append all targets of another table."""
+        if not self.filenames:
+            # Same rows, so the same keys and order.
+            self.sortkeys = dict((mode, []) for mode in other.sortkeys)
+            self.orders, self.ranks = dict(other.orders), dict(other.ranks)
+        if other.filenames:
+            self.extend_sortkeys(other.filenames, other.sortkeys)
+        ids = [self.get_rootid(root) for root in other.roots]
+        start = len(self.filenames)
+        if len(ids) == 1:
+            self.rootidx.extend(array("l", ids) * len(other))
+        else:
+            self.rootidx.extend(array("l", [ids[i] for i in other.rootidx]))
+        self.filenames.extend(other.filenames)
+        self.isdir.extend(other.isdir)
+        self.extpos.extend(other.extpos)
+        if self.lookup is not None:
+            lookup = self.lookup
+            for row in xrange(start, len(self)):
+                lookup[self.rootidx[row]][self.filenames[row]] = row
+
+    def select(self, rows):
+        """Return a new table with the targets at rows, in that order."""
+        table = TargetTable()
+        table.roots, table.rootids = list(self.roots), dict(self.rootids)
+        rootidx, filenames, extpos = self.rootidx, self.filenames, self.extpos
+        rows = list(rows)
+        table.rootidx = array("l", [rootidx[i] for i in rows])
+        table.filenames = [filenames[i] for i in rows]
+        table.isdir = array("b", [self.isdir[i] for i in rows])
+        table.extpos = array("l", [extpos[i] for i in rows])
+        for mode, keys in self.sortkeys.items():
+            table.sortkeys[mode] = [keys[i] for i in rows]
+        if self.orders and all(a < b for a, b in izip(rows, islice(rows, 1,
+                                                                    None))):
+            # Rows keep their relative order, so the sorted order can be
+            # filtered instead of sorting again.
+            newrows = array("l", [-1]) * len(self)
+            for new, old in enumerate(rows):
+                newrows[old] = new
+            for mode, (order, keys) in self.orders.items():
+                order = map(newrows.__getitem__, order)
+                kept = list(imap(operator.ge, order, repeat(0)))
+                table.orders[mode] = (array("l", compress(order, kept)),
+                                      list(compress(keys, kept)))
+        return table
+
+    def sorted(self, mode=0):
+        """Return a new table sorted by file name (see SORTKEYS)."""
+        return self.select(self.get_order(mode))
+
+    def extend_sortkeys(self, filenames, sortkeys=None):
+        """Add the keys of appended targets, taking them from sortkeys
+        where that has them already."""
+        for mode, keys in self.sortkeys.items():
+            if sortkeys is not None and mode in sortkeys:
+                keys.extend(sortkeys[mode])
+            else:
+                keys.extend(SORTKEYS[mode](filenames))
+
+    def get_sortkeys(self, mode=0):
+        if SORTKEYS[mode] is None:
+            return self.filenames
+        keys = self.sortkeys.get(mode)
+        if keys is None:
+            keys = self.sortkeys[mode] = SORTKEYS[mode](self.filenames)
+        return keys
+
+    def get_ranks(self, mode=0, perdir=False):
+        """Return the position of every row when sorted by mode, or with
+        perdir, its position among the targets of its directory. This is
+        what counters are assigned by."""
+        ranks = self.ranks.get((mode, perdir))
+        if ranks is not None and len(ranks) == len(self):
+            return ranks
+        ranks = array("l", [0]) * len(self)
+        if not perdir:
+            for pos, row in enumerate(self.get_order(mode)):
+                ranks[row] = pos
+        else:
+            counters = [0] * len(self.roots)
+            rootidx = self.rootidx
+            for row in self.get_order(mode):
+                rootid = rootidx[row]
+                ranks[row] = counters[rootid]
+                counters[rootid] += 1
+        self.ranks[(mode, perdir)] = ranks
+        return ranks
+
+    def get_order(self, mode=0):
+        """Return the rows sorted by mode. Equal keys keep their order."""
+        keys = self.get_sortkeys(mode)
+        cached = self.orders.get(mode)
+        if cached is not None and len(cached[0]) == len(self):
+            return cached[0]
+        if cached is not None and len(self) - len(cached[0]) <= len(cached[0]):
+            order, sortedkeys = self.merge_rows(cached, keys)
+        else:
+            order = array("l", sorted(xrange(len(self)), key=keys.__getitem__))
+            sortedkeys = map(keys.__getitem__, order)
+        self.orders[mode] = (order, sortedkeys)
+        return order
+
+    def merge_rows(self, cached, keys):
+        """Insert the rows appended since cached was sorted into it."""
+        order, sortedkeys = cached
+        merged, mergedkeys, pos = array("l"), [], 0
+        for row in sorted(xrange(len(order), len(self)), key=keys.__getitem__):
+            key = keys[row]
+            # After equal keys, as rows with equal keys stay in row order.
+            end = bisect.bisect_right(sortedkeys, key, pos)
+            merged.extend(order[pos:end])
+            mergedkeys.extend(sortedkeys[pos:end])
+            merged.append(row)
+            mergedkeys.append(key)
+            pos = end
+        merged.extend(order[pos:])
+        mergedkeys.extend(sortedkeys[pos:])
+        return merged, mergedkeys
+
+    def root(self, row):
+        return self.roots[self.rootidx[row]]
+
+    def path(self, row):
+        return self.roots[self.rootidx[row]] + self.filenames[row]
+
+    def paths(self):
+        roots = self.roots
+        return (roots[i] + f for i, f in izip(self.rootidx, self.filenames))
+
+    def names(self):
+        """Return the names of all targets without their extension."""
+        return [f[:pos] for f, pos in izip(self.filenames, self.extpos)]
+
+    def exts(self):
+        return [f[pos:] for f, pos in izip(self.filenames, self.extpos)]
+
+    def build_index(self):
+        """Index the targets by path for find()."""
+        lookup = dict((rootid, {}) for rootid in xrange(len(self.roots)))
+        for row, (rootid, f) in enumerate(izip(self.rootidx, self.filenames)):
+            lookup[rootid][f] = row
+        self.lookup = lookup
+
+    def find(self, path):
+        """Return the row of the target at path or None."""
+        if self.lookup is None:
+            self.build_index()
+        pos = path.rfind("/") + 1
+        rootid = self.rootids.get(path[:pos])
+        if rootid is None:
+            return
+        return self.lookup[rootid].get(path[pos:])
+
+
+class PreviewTable(object):
+    """The previewed names of the targets in a TargetTable.
+
+    Iterating yields the ((root, filename), preview) tuples previews used
+    to be."""
+
+    def __init__(self, targets=None, names=None):
+        self.targets = targets if targets is not None else TargetTable()
+        self.names = names if names is not None else []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        targets = self.targets
+        roots = targets.roots
+        for rootid, f, n in izip(targets.rootidx, targets.filenames,
+                                 self.names):
+            yield (roots[rootid], f), n
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return self.select(xrange(*row.indices(len(self))))
+        targets = self.targets
+        return (targets.root(row), targets.filenames[row]), self.names[row]
+
+    def __repr__(self):
+        return "<PreviewTable: {} previews, {} changed>".format(
+            len(self), self.count_changed())
+
+    def extend(self, other):
+        """Append another table's targets and previews."""
+        self.targets.extend(other.targets)
+        self.names.extend(other.names)
+
+    def select(self, rows):
+        rows = list(rows)
+        names = self.names
+        return PreviewTable(self.targets.select(rows), [names[i] for i in rows])
+
+    def find(self, path):
+        """Return the preview of the target at path or None."""
+        row = self.targets.find(path)
+        if row is None or row >= len(self.names):
+            return
+        return self.names[row]
+
+    def count_changed(self):
+        return sum(f != n for f, n in izip(self.targets.filenames, self.names))
+
+    def iter_changed(self):
+        """Yield (root, filename, preview) of targets that get renamed."""
+        targets = self.targets
+        roots = targets.roots
+        for rootid, f, n in izip(targets.rootidx, targets.filenames,
+                                 self.names):
+            if f != n:
+                yield roots[rootid], f, n
+
+    def actions(self, dirs=None):
+        """Yield the (source, destination) paths of all renames, or with
+        dirs True or False, only those of directories or of files."""
+        if dirs is None:
+            return ((root + f, root + n) for root, f, n in self.iter_changed())
+        targets = self.targets
+        roots = targets.roots
+        return ((roots[rootid] + f, roots[rootid] + n) for rootid, f, n, isdir
+                in izip(targets.rootidx, targets.filenames, self.names,
+                        targets.isdir) if f != n and isdir == dirs)
+
+
+class LazyPreviewTable(object):
+    """Previews of a TargetTable that are computed when they are asked for.
+
+    find() transforms the requested target together with a window of its
+    neighbours in the view, which the caller lists with nearby, and keeps
+    the results in an LRU cache of cachesize previews. Without nearby, the
+    neighbours in the table are taken, which is scandir order. Counters
+    only depend on the position of a target, so they come out the same as
+    if all targets were transformed at once. Use resolve() for the complete
+    PreviewTable, e.g. to commit it."""
+
+    def __init__(self, fileops, targets=None, cachesize=8192, prefetch=256):
+        self.fileops = fileops
+        self.targets = targets if targets is not None else TargetTable()
+        self.cachesize = cachesize
+        self.prefetch = prefetch
+        self.cache = collections.OrderedDict()  # row -> preview
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        return "<LazyPreviewTable: {} targets, {} cached>".format(
+            len(self), len(self.cache))
+
+    def get(self, row, nearby=None):
+        """Return the preview of the target at row."""
+        cache = self.cache
+        if row not in cache and not self.fetch(row, nearby):
+            return
+        preview = cache[row] = cache.pop(row)  # Most recently used last.
+        return preview
+
+    def fetch(self, row, nearby=None):
+        """Transform the target at row and the uncached ones around it.
+
+        nearby(before, after) returns the paths of up to before targets
+        ahead of it and after targets behind it in view order."""
+        targets, cache = self.targets, self.cache
+        # While targets are streamed in, extpos is the last column to grow.
+        stop = min(len(targets.extpos), len(targets))
+        if row >= stop:
+            return False
+        before, after = self.prefetch // 4, self.prefetch
+        if nearby is None:
+            near = xrange(max(0, row - before), min(stop, row + after))
+        else:
+            near = imap(targets.find, nearby(before, after))
+        rows = [row]
+        rows.extend(r for r in near if r is not None and r < stop and
+                    r != row and r not in cache)
+        window = TargetTable()
+        for r in rows:
+            window.append(*targets[r])
+        fileops = self.fileops
+        counts = None
+        if fileops.countcheck:
+            counts = fileops.get_counts(targets, rows)
+        # Rows are fetched for the view, which a cancelled update must not
+        # leave blank.
+        previews = fileops.modify_previews(window, counts, parallel=False,
+                                           cache=False, stoppable=False)
+        if previews is None:
+            return False
+        cache.update(izip(rows, previews.names))
+        while len(cache) > self.cachesize:
+            cache.popitem(last=False)
+        return True
+
+    def extend(self, other):
+        """Append another table's targets, and its previews to the cache."""
+        start = len(self.targets)
+        self.targets.extend(other.targets)
+        if isinstance(other, PreviewTable):
+            self.cache.update(izip(xrange(start, len(self.targets)),
+                                   other.names))
+
+    def select(self, rows):
+        return LazyPreviewTable(self.fileops, self.targets.select(rows),
+                                self.cachesize, self.prefetch)
+
+    def find(self, path, nearby=None):
+        """Return the preview of the target at path or None. See fetch for
+        nearby."""
+        row = self.targets.find(path)
+        if row is None:
+            return
+        return self.get(row, nearby)
+
+    def resolve(self):
+        """Transform all targets and return them as a PreviewTable. Unlike
+        an update, this is not stopped by stopupdate."""
+        return self.fileops.get_previews(self.targets, stoppable=False)
@@ -0,0 +1,301 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+
+import helpers
+
+
+log = logging.getLogger("watcher")
+
+# Flags from <sys/inotify.h>.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCHMASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+EVENTHEADER = struct.Struct("iIII")
+
+
+def load_inotify():
+    "Return libc if it provides inotify, otherwise None."
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return
+    return libc
+
+
+class Watcher(object):
+    """Watch a tree of directories for created and deleted entries.
+
+    Uses inotify on Linux and falls back to polling the mtime of the
+    watched directories elsewhere. Polling happens on a background thread,
+    pollsize directories per interval seconds, so its cost per round does
+    not grow with the tree (but the time until a change shows up does).
+    A rename shows up as a delete of the old
+    name followed by a create of the new one. poll() returns a list of
+    (event, root, name, isdir) tuples where event is "create" or
+    "delete", root ends with a slash and isdir tells whether the entry is
+    a directory. New directories are watched and their contents reported
+    as created, down to levels below the top directory. An ("overflow",
+    None, None, None) event means changes were lost and a full rescan is
+    needed. If a directory can't be watched, e.g. because the inotify
+    watch limit is reached, complete is False until clear() is called and
+    callers have to rescan to see changes."""
+
+    def __init__(self, levels=0, pollsize=256, interval=1.0):
+        self.levels = levels
+        self.libc = load_inotify()
+        self.fd = None
+        self.paths = {}  # path -> level
+        self.wds = {}  # inotify watch descriptor -> path
+        self.pathwds = {}  # path -> inotify watch descriptor
+        self.complete = True  # Whether all directories could be watched.
+        # Polling only, shared with the polling thread through lock:
+        self.listings = {}  # path -> (mtime, dirs, files)
+        self.queue = collections.deque()  # Paths in the order they are polled.
+        self.queued = set()  # Paths in queue.
+        self.changes = []  # Changes found since the last poll().
+        self.pollsize = pollsize
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.poller = None
+        self.stopped = threading.Event()
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+            if self.fd < 0:
+                log.warn("inotify unavailable, polling directories instead.")
+                self.fd = None
+        log.debug("Watching with {}.".format(self.mode))
+
+    @property
+    def mode(self):
+        return "inotify" if self.fd is not None else "polling"
+
+    @property
+    def watching(self):
+        return bool(self.paths)
+
+    def close(self):
+        self.clear()
+        self.stopped.set()
+        if self.poller is not None:
+            self.poller.join()
+            self.poller = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def clear(self):
+        """Stop watching all directories and drop queued events."""
+        if self.fd is not None:
+            for wd in self.wds:
+                self.libc.inotify_rm_watch(self.fd, wd)
+            self.drain()
+        self.paths, self.wds, self.pathwds = {}, {}, {}
+        self.complete = True
+        with self.lock:
+            self.listings = {}
+            self.queue.clear()
+            self.queued = set()
+            self.changes = []
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except OSError:
+            pass
+
+    def watch(self, path, level=0, listing=None):
+        """Start watching the directory at path, level below the top.
+
+        When polling, the directory is listed by the polling thread, or
+        compared against listing, its (dirs, files) if the caller has them
+        already."""
+        path = path.rstrip("/") or "/"
+        if path in self.paths:
+            return
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, path, WATCHMASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                log.debug("Could not watch {}: {}.".format(path,
+                                                           os.strerror(err)))
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone already, which a delete event reports.
+                    return
+                if self.complete:
+                    log.warn("Could not watch {} ({}), changes are picked "
+                             "up by rescans only.".format(path,
+                                                         os.strerror(err)))
+                self.complete = False
+                return
+            self.wds[wd] = path
+            self.pathwds[path] = wd
+        else:
+            if listing is not None:
+                listing = (None, set(listing[0]), set(listing[1]))
+            with self.lock:
+                self.listings[path] = listing
+                if path not in self.queued:
+                    self.queued.add(path)
+                    self.queue.append(path)
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.run_poller,
+                                               name="watcher")
+                self.poller.daemon = True
+                self.poller.start()
+        self.paths[path] = level
+
+    def unwatch(self, path):
+        """Stop watching path and all watched directories below it."""
+        path = path.rstrip("/") or "/"
+        prefix = path.rstrip("/") + "/"
+        for p in [p for p in self.paths if p == path or p.startswith(prefix)]:
+            del self.paths[p]
+            with self.lock:
+                # The poller drops it from queue when it gets to it.
+                self.listings.pop(p, None)
+            wd = self.pathwds.pop(p, None)
+            if wd is not None:
+                self.wds.pop(wd, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def poll(self):
+        """Return the events that happened since the last call."""
+        if self.fd is not None:
+            changes = self.read_events()
+        else:
+            with self.lock:
+                changes, self.changes = self.changes, []
+
+        events = []
+        for event in changes:
+            events.append(event)
+            kind, root, name, isdir = event
+            if not isdir:
+                continue
+            path, parent = root + name, root.rstrip("/") or "/"
+            if kind == "delete":
+                self.unwatch(path)
+            elif parent in self.paths and self.paths[parent] < self.levels:
+                events.extend(self.add_tree(path, self.paths[parent] + 1))
+
+        return events
+
+    def add_tree(self, path, level):
+        """Watch a new directory and report everything in it as created."""
+        events = []
+        walk = helpers.walklevels(path, self.levels - level)
+        for root, dirs, files in walk:
+            rootlevel = level + root[len(path):].count("/")
+            if root == path:
+                self.watch(path, level, (dirs, files))
+            if rootlevel < self.levels:
+                for d in dirs:
+                    self.watch(os.path.join(root, d), rootlevel + 1)
+            root += "/"
+            events.extend(("create", root, d, True) for d in dirs)
+            events.extend(("create", root, f, False) for f in files)
+        return events
+
+    def read_events(self):
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENTHEADER.unpack_from(data, offset)
+                offset += EVENTHEADER.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    log.warn("inotify queue overflowed.")
+                    return [("overflow", None, None, None)]
+                if mask & IN_IGNORED:
+                    path = self.wds.pop(wd, None)
+                    if path is not None:
+                        self.pathwds.pop(path, None)
+                        self.paths.pop(path, None)
+                    continue
+                root = self.wds.get(wd)
+                if root is None:
+                    continue
+                root = root.rstrip("/") + "/"
+                isdir = bool(mask & IN_ISDIR)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changes.append(("create", root, name, isdir))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changes.append(("delete", root, name, isdir))
+        return changes
+
+    def run_poller(self):
+        while not self.stopped.wait(self.interval):
+            self.scan_listings()
+
+    def scan_listings(self):
+        """Check the next pollsize directories of the queue for changes."""
+        with self.lock:
+            count = min(self.pollsize, len(self.queue))
+            paths = [self.queue.popleft() for _ in xrange(count)]
+            self.queued.difference_update(paths)
+        for path in paths:
+            with self.lock:
+                if path not in self.listings:
+                    continue  # Unwatched meanwhile.
+                listing = self.listings[path]
+            changes = []
+            try:
+                newmtime = os.stat(path).st_mtime
+                if listing is not None and newmtime == listing[0]:
+                    newlisting = listing
+                else:
+                    newdirs, newfiles, _ = helpers.listdir(path)
+                    newlisting = (newmtime, set(newdirs), set(newfiles))
+            except OSError:
+                # Its parent reports the delete.
+                newlisting = listing
+            if listing is not None and newlisting is not listing:
+                _, dirs, files = listing
+                _, newdirs, newfiles = newlisting
+                root = path.rstrip("/") + "/"
+                changes.extend(("delete", root, d, True)
+                               for d in dirs - newdirs)
+                changes.extend(("delete", root, f, False)
+                               for f in files - newfiles)
+                changes.extend(("create", root, d, True)
+                               for d in newdirs - dirs)
+                changes.extend(("create", root, f, False)
+                               for f in newfiles - files)
+            with self.lock:
+                # Skip it if it was unwatched or cleared meanwhile.
+                if self.listings.get(path, False) is listing:
+                    self.listings[path] = newlisting
+                    self.changes.extend(changes)
+                if path in self.listings and path not in self.queued:
+                    self.queued.add(path)
+                    self.queue.append(path)
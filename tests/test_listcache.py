@@ -0,0 +1,75 @@
+"""Persistence and pruning of the directory listing cache.
+
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+import helpers
+from listcache import ListingCache
+
+
+class ListingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="demimove-test-")
+        self.root = os.path.join(self.tmpdir, "tree")
+        for name in ["a/x", "b"]:
+            os.makedirs(os.path.join(self.root, name))
+        self.age()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def age(self, *names):
+        """Move the mtimes of the named dirs, or of all, out of the grace
+        period of the cache."""
+        hourago = time.time() - 3600
+        for root, dirs, files in os.walk(self.root):
+            if not names or os.path.relpath(root, self.root) in names:
+                os.utime(root, (hourago, hourago))
+
+    def walk(self, cache):
+        list(helpers.walklevels(self.root, 5, cache.listdir))
+        cache.save()
+        return sorted(os.path.relpath(path, self.root)
+                      for path in ListingCache(self.tmpdir).listings)
+
+    def test_save_appends_changes(self):
+        cache = ListingCache(self.tmpdir)
+        self.assertEqual(self.walk(cache), [".", "a", "a/x", "b"])
+        size = os.path.getsize(cache.cachefile)
+        open(os.path.join(self.root, "b", "file"), "w").close()
+        self.age("b")
+        self.walk(cache)
+        self.assertEqual(cache.records, 5)
+        self.assertTrue(size < os.path.getsize(cache.cachefile))
+
+    def test_renamed_directory_is_pruned(self):
+        cache = ListingCache(self.tmpdir)
+        self.walk(cache)
+        os.rename(os.path.join(self.root, "a"), os.path.join(self.root, "c"))
+        self.age(".")
+        self.assertEqual(self.walk(cache), [".", "b", "c", "c/x"])
+
+    def test_truncated_file_is_rewritten(self):
+        cache = ListingCache(self.tmpdir)
+        self.walk(cache)
+        with open(cache.cachefile, "ab") as f:
+            f.write("\x80\x02(U")
+        cache = ListingCache(self.tmpdir)
+        self.assertEqual(len(cache.listings), 4)
+        open(os.path.join(self.root, "b", "file"), "w").close()
+        self.age("b")
+        self.assertEqual(self.walk(cache), [".", "a", "a/x", "b"])
+        self.assertEqual(cache.records, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Resume and rollback of interrupted commits.
+
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        # The history store and journal live below HOME.
+        self.tmpdir = tempfile.mkdtemp(prefix="demimove-test-")
+        self.home = os.environ.get("HOME")
+        os.environ["HOME"] = self.tmpdir
+        from fileops import FileOps
+        self.fileops = FileOps(quiet=True)
+        self.root = os.path.join(self.tmpdir, "tree")
+        os.makedirs(self.root)
+        for name in ["a", "b", "c"]:
+            open(self.path(name), "w").close()
+        self.interrupt()
+
+    def tearDown(self):
+        self.fileops.historystore.close()
+        if self.home is not None:
+            os.environ["HOME"] = self.home
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def interrupt(self):
+        """Leave a journal behind as if a commit of a, b, c -> A, B, C
+        crashed after its first rename."""
+        journal = self.fileops.journal
+        self.plan = [(self.path(n), self.path(n.upper())) for n in "abc"]
+        journal.begin(self.plan)
+        os.rename(*self.plan[0])
+        journal.record(*self.plan[0])
+        journal.f.close()
+        journal.f = None
+
+    def test_resume(self):
+        self.assertEqual(self.fileops.resume(), self.plan[1:])
+        self.assertEqual(sorted(os.listdir(self.root)), ["A", "B", "C"])
+        self.assertFalse(self.fileops.journal.exists())
+
+    def test_simulated_resume(self):
+        self.fileops.simulate = True
+        self.assertEqual(self.fileops.resume(), self.plan[1:])
+        self.assertEqual(sorted(os.listdir(self.root)), ["A", "b", "c"])
+        self.assertTrue(self.fileops.journal.exists())
+
+    def test_simulated_rollback(self):
+        self.fileops.simulate = True
+        self.fileops.rollback()
+        self.assertEqual(sorted(os.listdir(self.root)), ["A", "b", "c"])
+        self.assertTrue(self.fileops.journal.exists())
+
+    def test_running_commit_is_left_alone(self):
+        # Another instance holding the journal is still running its commit.
+        from journal import Journal
+        other = Journal(self.fileops.configdir)
+        self.assertTrue(other.acquire())
+        try:
+            self.assertIsNone(self.fileops.get_interrupted())
+            self.assertEqual(self.fileops.resume(), [])
+            self.fileops.rollback()
+            done, skipped = self.fileops.commit_actions(
+                [(self.path("b"), self.path("d"))])
+            self.assertEqual(skipped[0][2], "another commit is running")
+        finally:
+            other.release()
+        self.assertEqual(sorted(os.listdir(self.root)), ["A", "b", "c"])
+        self.assertEqual(self.fileops.resume(), self.plan[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Undo of stored commits.
+
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "demimove"))
+
+
+class UndoCommitTest(unittest.TestCase):
+
+    def setUp(self):
+        # The history store and journal live below HOME.
+        self.tmpdir = tempfile.mkdtemp(prefix="demimove-test-")
+        self.home = os.environ.get("HOME")
+        os.environ["HOME"] = self.tmpdir
+        from fileops import FileOps
+        self.fileops = FileOps(quiet=True)
+        self.root = os.path.join(self.tmpdir, "tree")
+        os.makedirs(os.path.join(self.root, "dir"))
+        for name in ["dir/inner", "a", "b"]:
+            with open(os.path.join(self.root, name), "w") as f:
+                f.write(name)
+
+    def tearDown(self):
+        self.fileops.historystore.close()
+        if self.home is not None:
+            os.environ["HOME"] = self.home
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def commit(self, renames):
+        actions = [(self.path(src), self.path(dst)) for src, dst in renames]
+        done, skipped = self.fileops.commit_actions(actions)
+        self.assertEqual(skipped, [])
+        return self.fileops.record_history(done)
+
+    def listing(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.root)
+                      for root, dirs, files in os.walk(self.root)
+                      for name in dirs + files)
+
+    def test_undo_inside_renamed_directory(self):
+        before = self.listing()
+        # The contents are renamed before their directory, so the stored
+        # path of inner is below the old directory name.
+        commitid = self.commit([("dir/inner", "dir/outer"),
+                                ("dir", "renamed")])
+        self.assertEqual(self.listing(), ["a", "b", "renamed",
+                                          "renamed/outer"])
+        self.assertEqual(self.fileops.get_undo_conflicts(commitid), [])
+        self.assertTrue(self.fileops.undo_commit(commitid))
+        self.assertEqual(self.listing(), before)
+
+    def test_undo_swap(self):
+        commitid = self.commit([("a", "b"), ("b", "a")])
+        with open(self.path("a")) as f:
+            self.assertEqual(f.read(), "b")
+        self.assertTrue(self.fileops.undo_commit(commitid))
+        with open(self.path("a")) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_streamed_swap(self):
+        swap = [(self.path("a"), self.path("b")),
+                (self.path("b"), self.path("a"))]
+        [(done, skipped)] = self.fileops.commit_stream([(swap, [])])
+        # Reported as asked for, the temporary name is only in the history.
+        self.assertEqual((sorted(done), skipped), (swap, []))
+        self.assertTrue(self.fileops.undo_commit())
+        with open(self.path("a")) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_changed_target_blocks_undo(self):
+        commitid = self.commit([("dir/inner", "dir/outer"),
+                                ("dir", "renamed")])
+        os.remove(self.path("renamed/outer"))
+        conflicts = self.fileops.get_undo_conflicts(commitid)
+        self.assertEqual(conflicts, [self.path("dir/outer")])
+        self.assertFalse(self.fileops.undo_commit(commitid))
+        self.assertEqual(self.listing(), ["a", "b", "renamed"])
+
+
+if __name__ == "__main__":
+    unittest.main()